@@ -0,0 +1,186 @@
+#benchmark the entailment, validation and serialisation pipeline of update_vocabs.py over fixed corpora
+#example call arguments ( from the repository root ):
+#
+# -o benchmark.json
+# -o benchmark.json --baseline scripts/benchmark_baseline.json --threshold 0.25
+# -c definitions/conceptschemes,scripts/tests --repeat 3 --save-baseline scripts/benchmark_baseline.json
+#
+# source files are copied to a temporary directory so outputs and validation reports are written there, and
+# nothing is uploaded. Each run starts with empty caches and a fresh copy of the sources in its own directory there
+
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from glob import glob
+from statistics import median
+
+import update_vocabs
+from update_vocabs import DOMAIN_CFG, get_entailed_closure, process_file
+
+CORPORA = ['definitions/conceptschemes', 'specification-elements/defs', 'definitions/profiles', 'definitions/docs',
+           'scripts/tests']
+
+# stages taking less than this in the baseline are too noisy to flag
+MIN_SECONDS = 0.05
+
+
+def stage_key(timing):
+    """ e.g. entail:scripts/skosbasics.shapes.ttl , serialize:jsonld , validate """
+    detail = timing['args'].get('rules') or timing['args'].get('format')
+    return timing['stage'] + (":" + detail if detail else "")
+
+
+def clear_caches(workdir):
+    """ start cold - forget the file hashes, rule sets, validators and closures kept by earlier runs, and parse into a
+    new cache directory under workdir rather than using ( or filling ) the repository's """
+    for cache in (update_vocabs._HASH_CACHE, update_vocabs._ENTAILER_CACHE, update_vocabs._VALIDATOR_CACHE,
+                  update_vocabs._CLOSURE_CACHE):
+        cache.clear()
+    update_vocabs.CACHE_DIR = tempfile.mkdtemp(prefix="cache", dir=workdir)
+
+
+def run_corpus(scopepath, workdir):
+    """ run the pipeline over every file of a domain, with nothing cached or written by earlier runs - sources are
+    copied to a new directory under workdir, so every run writes all its outputs
+    @return: { 'files': { file: seconds }, 'failed': [ files ], 'stages': { stage key: seconds }, 'seconds': total }
+    """
+    rundir = tempfile.mkdtemp(prefix="run", dir=workdir)
+    clear_caches(rundir)
+    update_vocabs.STAGE_TIMINGS = []
+    files = {}
+    failed = []
+    start = time.perf_counter()
+    cfglist = DOMAIN_CFG[scopepath]
+    for cfg in cfglist if isinstance(cfglist, list) else [cfglist]:
+        extra = get_entailed_closure(cfg['extraont'], cfg['rulelist']) if cfg.get('extraont') else None
+        for f in sorted(glob(scopepath + cfg['glob'])):
+            copy = os.path.join(rundir, f)
+            os.makedirs(os.path.dirname(copy), exist_ok=True)
+            shutil.copy(f, copy)
+            filestart = time.perf_counter()
+            try:
+                with redirect_stdout(io.StringIO()):
+                    process_file(copy, cfg, extra)
+            except Exception as e:
+                print("Failed to generate {} : ( {} )".format(f, str(e).splitlines()[0] if str(e) else e))
+                failed.append(f.replace(os.sep, '/'))
+                continue
+            files[f.replace(os.sep, '/')] = time.perf_counter() - filestart
+    seconds = time.perf_counter() - start
+    stages = {}
+    for timing in update_vocabs.STAGE_TIMINGS:
+        stages[stage_key(timing)] = stages.get(stage_key(timing), 0.0) + timing['seconds']
+    update_vocabs.STAGE_TIMINGS = None
+    return {'files': files, 'failed': failed, 'stages': stages, 'seconds': seconds}
+
+
+def summarise(runs):
+    """ median of each timing over repeated runs of a corpus - of files which succeeded in every run """
+    succeeded = set.intersection(*(set(r['files']) for r in runs))
+    return {
+        'seconds': median(r['seconds'] for r in runs),
+        'files': {f: median(r['files'][f] for r in runs) for f in sorted(succeeded)},
+        'failed': sorted(set(f for r in runs for f in r['failed'])),
+        'stages': {s: median(r['stages'].get(s, 0.0) for r in runs) for s in runs[0]['stages']},
+    }
+
+
+def regressions(results, baseline, threshold):
+    """ corpus totals and stages slower than the baseline by more than threshold ( a fraction ) """
+    found = []
+    for corpus, base in baseline['corpora'].items():
+        if corpus not in results['corpora']:
+            continue
+        new = results['corpora'][corpus]
+        checks = [('total', base['seconds'], new['seconds'])] + \
+                 [(s, t, new['stages'].get(s)) for s, t in base['stages'].items()]
+        for name, was, now in checks:
+            if now is not None and was >= MIN_SECONDS and now > was * (1 + threshold):
+                found.append("{} {} : {:.3f}s -> {:.3f}s ( +{:.0%} )".format(corpus, name, was, now, now / was - 1))
+    return found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-c",
+        "--corpora",
+        default=",".join(CORPORA),
+        help="domains to benchmark - default = " + ",".join(CORPORA),
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        help="number of runs of each corpus - medians are reported",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="write results to this JSON file",
+    )
+    parser.add_argument(
+        "--baseline",
+        help="JSON results to compare with - regressions are reported and give a non-zero exit code",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="fraction a corpus or stage may be slower than the baseline before it is flagged - default = 0.2",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        help="also write results to this file, as the baseline for later runs",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=update_vocabs.ENGINES,
+        default=update_vocabs.ENGINE,
+        help="SHACL rule engine - default = {}".format(update_vocabs.ENGINE),
+    )
+    parser.add_argument(
+        "--no-parse-cache",
+        action='store_true',
+        help="always parse turtle sources rather than loading them from the parse cache",
+    )
+    args = parser.parse_args()
+    update_vocabs.ENGINE = args.engine
+    update_vocabs.PARSE_CACHE = not args.no_parse_cache
+
+    results = {
+        'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'engine': args.engine,
+        'parse_cache': update_vocabs.PARSE_CACHE,
+        'repeat': args.repeat,
+        'corpora': {},
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        for corpus in args.corpora.split(","):
+            runs = [run_corpus(corpus, workdir) for _ in range(args.repeat)]
+            results['corpora'][corpus] = summarise(runs)
+            print("{} : {} files {:.2f}s".format(corpus, len(runs[0]['files']), results['corpora'][corpus]['seconds']))
+            for s, t in sorted(results['corpora'][corpus]['stages'].items(), key=lambda st: -st[1]):
+                print("   {:60} {:8.3f}s".format(s, t))
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as rf:
+                json.dump(results, rf, indent=1, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as bf:
+            found = regressions(results, json.load(bf), args.threshold)
+        for r in found:
+            print("REGRESSION " + r)
+        print("{} regressions against {} ( threshold {:.0%} )".format(len(found), args.baseline, args.threshold))
+        sys.exit(1 if found else 0)
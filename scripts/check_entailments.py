@@ -0,0 +1,135 @@
+#check that a SHACL rule engine reproduces the entailed/ outputs in the repository - or the pyshacl engine
+#example call arguments ( from the repository root ):
+#
+# --engine native -d specification-elements/defs
+# --engine native --reference pyshacl -f definitions/conceptschemes/status.ttl,definitions/profiles/skos.ttl
+
+import argparse
+import os
+import sys
+import time
+from glob import glob
+
+from rdflib import Graph, Literal, URIRef
+from rdflib.compare import graph_diff, isomorphic, to_isomorphic
+from rdflib.namespace import DCTERMS, XSD
+
+import update_vocabs
+from update_vocabs import DOMAIN_CFG, ENGINES, Entailer, get_closure_graph, get_entailed_closure, \
+    get_entailedpath, parse_turtle, perform_entailments
+
+# set by rules to the time of entailment - never reproducible
+TIMESTAMPS = (DCTERMS.created, DCTERMS.modified)
+
+
+def normalised(g: Graph, f) -> Graph:
+    """ g without timestamps, and with relative IRIs resolved against the source file made independent of
+    where the repository was checked out """
+    source = "/" + f.replace(os.sep, "/")
+    cleaned = Graph()
+    for t in g:
+        if t[1] in TIMESTAMPS and isinstance(t[2], Literal) and t[2].datatype == XSD.dateTime:
+            continue
+        cleaned.add(tuple(URIRef("file://" + term[term.index(source):])
+                          if isinstance(term, URIRef) and term.startswith("file:") and source in term else term
+                          for term in t))
+    return cleaned
+
+
+def pyshacl_entailments(f, cfg):
+    """ the entailments of perform_entailments() made with the pyshacl engine """
+    entailer = Entailer(cfg['rulelist'], engine='pyshacl')
+    extra = None
+    if cfg.get('extraont'):
+        extra = entailer.entail(get_closure_graph(cfg['extraont']))
+    g = parse_turtle(f)
+    g += entailer.derive(g, extra)
+    return g
+
+
+def check_file(f, cfg, extra, reference='outputs'):
+    """ entail a source file in memory and compare with its entailed turtle output, or with pyshacl
+    @return: list of differences - empty if the same
+    """
+    newg = perform_entailments(cfg['rulelist'], f, extra=extra)
+    if reference == 'pyshacl':
+        expected = pyshacl_entailments(f, cfg)
+    else:
+        path = get_entailedpath(f, newg, 'ttl', rootpattern=cfg['uri_root_filter'])[0]
+        if not os.path.exists(path):
+            return ["no existing output {}".format(path)]
+        expected = Graph().parse(path, format="ttl")
+    a = normalised(expected, f)
+    b = normalised(newg, f)
+    if isomorphic(a, b):
+        return []
+    _, missing, extra_triples = graph_diff(to_isomorphic(a), to_isomorphic(b))
+    return ["- {} {} {}".format(*(term.n3() for term in t)) for t in missing] + \
+           ["+ {} {} {}".format(*(term.n3() for term in t)) for t in extra_triples]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-d",
+        "--domain",
+        help="check specific domain",
+    )
+    parser.add_argument(
+        "-f",
+        "--files",
+        help="check specific files",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=ENGINES,
+        default=update_vocabs.ENGINE,
+        help="SHACL rule engine - default = {}".format(update_vocabs.ENGINE),
+    )
+    parser.add_argument(
+        "--reference",
+        choices=('outputs', 'pyshacl'),
+        default='outputs',
+        help="compare with the existing entailed/ outputs, or with entailments made by pyshacl",
+    )
+    parser.add_argument(
+        "--iterate-rules",
+        action='store_true',
+        help="repeat each shape's rules until they entail nothing new",
+    )
+    args = parser.parse_args()
+    update_vocabs.ENGINE = args.engine
+    update_vocabs.ITERATE_RULES = args.iterate_rules
+    files = [os.path.normpath(f) for f in args.files.split(",")] if args.files else None
+
+    checked = 0
+    failed = []
+    for scopepath, cfglist in DOMAIN_CFG.items():
+        if args.domain and args.domain != scopepath:
+            continue
+        for cfg in cfglist if isinstance(cfglist, list) else [cfglist]:
+            domainlist = [os.path.normpath(i) for i in glob(scopepath + cfg['glob'])]
+            if files is not None:
+                domainlist = [f for f in domainlist if f in files]
+            if not domainlist:
+                continue
+            extra = get_entailed_closure(cfg['extraont'], cfg['rulelist']) if cfg.get('extraont') else None
+            for f in sorted(domainlist):
+                start = time.time()
+                checked += 1
+                try:
+                    diffs = check_file(f, cfg, extra, args.reference)
+                except Exception as e:
+                    print("FAILED {} ( {} )".format(f, " ".join(str(e).split()) or repr(e)))
+                    failed.append(f)
+                    continue
+                print("{} {} ( {:.2f}s )".format("DIFFERENT" if diffs else "SAME", f, time.time() - start))
+                for d in diffs[:20]:
+                    print("   " + d)
+                if diffs:
+                    failed.append(f)
+
+    print("{} of {} files differ from, or could not be compared with, the {} using the {} engine".format(
+        len(failed), checked, "existing entailed outputs" if args.reference == 'outputs' else "pyshacl entailments",
+        args.engine))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,104 @@
+#write a graph as RDF/XML, deterministically and straight to a stream
+#
+# the layout is that of rdflib's plain ( "xml" ) serialiser - a flat rdf:Description per subject, blank nodes given
+# as rdf:nodeID - but subjects, predicates and objects are written in sorted order, prefixes are generated for
+# predicates in sorted order, and blank nodes are ordered and labelled by what they describe and what refers to them
+# ( as by turtle_writer ) rather than by their random ids. rdflib's serialiser walks the store's sets, so its output
+# changes with the process hash seed even when the graph does not.
+#
+# example use:
+#
+# with open("out.rdf", "wb") as out:
+#     write_rdfxml(g, out)
+
+from xml.sax.saxutils import escape, quoteattr
+
+from rdflib import RDF, BNode, Literal, URIRef
+from rdflib.plugins.serializers.xmlwriter import ESCAPE_ENTITIES
+
+from turtle_writer import compare_terms, get_bnode_keys
+
+
+class RDFXMLWriter:
+    """ writes one graph - see write_rdfxml() """
+
+    def __init__(self, g, stream, encoding="utf-8"):
+        self.g = g
+        self.stream = stream
+        self.encoding = encoding
+        self.keys = get_bnode_keys(g)
+        self.order = compare_terms(self.keys)
+        self.labels = {}
+        self.used = set()
+        self.qnames = {}
+
+    def write(self, text: str):
+        self.stream.write(text.encode(self.encoding, "replace"))
+
+    def node_id(self, node) -> str:
+        """ label of a blank node from its key - numbered where keys collide, in the order written """
+        if node not in self.labels:
+            label = "b" + self.keys[node][:16]
+            n = 1
+            while label in self.used:
+                n += 1
+                label = "b{}_{}".format(self.keys[node][:16], n)
+            self.labels[node] = label
+            self.used.add(label)
+        return self.labels[node]
+
+    def bindings(self) -> list:
+        """ ( prefix, namespace ) of each predicate's namespace, and rdf's - qnames are computed for predicates in
+        sorted order, so generated prefixes ( ns1, ns2 ... ) are numbered the same way every time """
+        nm = self.g.namespace_manager
+        bindings = {}
+        for p in sorted(set(self.g.predicates())):
+            prefix, namespace, name = nm.compute_qname_strict(p)
+            bindings[prefix] = URIRef(namespace)
+            self.qnames[p] = "{}:{}".format(prefix, name) if prefix else name
+        bindings.setdefault("rdf", URIRef(str(RDF)))
+        return sorted(bindings.items())
+
+    def predicate(self, p, o, indent):
+        qname = self.qnames[p]
+        if isinstance(o, Literal):
+            attributes = ""
+            if o.language:
+                attributes += ' xml:lang="%s"' % o.language
+            if o.datatype:
+                attributes += ' rdf:datatype="%s"' % o.datatype
+            self.write("%s<%s%s>%s</%s>\n" % (indent, qname, attributes, escape(o, ESCAPE_ENTITIES), qname))
+        elif isinstance(o, BNode):
+            self.write('%s<%s rdf:nodeID="%s"/>\n' % (indent, qname, self.node_id(o)))
+        else:
+            self.write("%s<%s rdf:resource=%s/>\n" % (indent, qname, quoteattr(o)))
+
+    def subject(self, s):
+        if isinstance(s, BNode):
+            self.write('  <rdf:Description rdf:nodeID="%s">\n' % self.node_id(s))
+        else:
+            self.write("  <rdf:Description rdf:about=%s>\n" % quoteattr(s))
+        for p, o in sorted(self.g.predicate_objects(s), key=lambda po: (po[0], self.order(po[1]))):
+            self.predicate(p, o, "    ")
+        self.write("  </rdf:Description>\n")
+
+    def run(self):
+        self.write('<?xml version="1.0" encoding="%s"?>\n' % self.encoding)
+        self.write("<rdf:RDF\n")
+        for prefix, namespace in self.bindings():
+            if prefix:
+                self.write('   xmlns:%s="%s"\n' % (prefix, namespace))
+            else:
+                self.write('   xmlns="%s"\n' % namespace)
+        self.write(">\n")
+        for s in sorted(set(self.g.subjects()), key=lambda s: (isinstance(s, BNode), self.order(s))):
+            self.subject(s)
+        self.write("</rdf:RDF>\n")
+
+
+def write_rdfxml(g, stream, encoding="utf-8"):
+    """ write a graph as RDF/XML - the same graph always gives the same bytes
+    @param g: rdflib Graph - prefixes are taken from its namespace manager
+    @param stream: binary stream to write to
+    """
+    RDFXMLWriter(g, stream, encoding).run()
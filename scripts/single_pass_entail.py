@@ -16,9 +16,8 @@ from urllib.parse import urlencode, quote_plus
 
 
 import sys
-from pyshacl import validate
 from rdflib import Graph, URIRef
-from update_vocabs import get_closure_graph
+from update_vocabs import get_closure_graph, Entailer
 
 f = sys.argv[1]
 rules = sys.argv[2]
@@ -26,12 +25,8 @@ ont_g1 = sys.argv[3]
 ont_g2 = sys.argv[4]
 
 g = Graph().parse(str(f), format="ttl")
-shg = Graph().parse(rules, format="ttl")
 extra = get_closure_graph([ont_g1, ont_g2])
 
-try:
-    validate(g, shacl_graph=shg, ont_graph=extra, advanced=True, inplace=True)
-except Exception as e:
-    raise Exception("SHACL error in {}: {}".format(rules, str(e)))
+Entailer([rules]).entail(g, extra)
 g.serialize(destination=f+'.out', format='ttl')
 
@@ -0,0 +1,331 @@
+#generate synthetic concept schemes, specifications and ontologies shaped like the real domain inputs, and measure how
+#the update_vocabs.py pipeline scales with their size
+#example call arguments ( from the repository root ):
+#
+# generate --kind skos --size 100000 --depth 4 --fanout 10 -o /tmp/skos_100k.ttl
+# scale --kind skos --sizes 1000,10000,100000 --csv /tmp/skos_scaling.csv --plot /tmp/skos_scaling.png
+# scale --kind spec --sizes 1000,5000,20000 --csv /tmp/spec_scaling.csv
+
+import argparse
+import csv
+import io
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+
+KINDS = ('skos', 'spec', 'owl')
+
+# the domain configuration each kind of input is processed with - ( DOMAIN_CFG key, index if it is a list )
+KIND_DOMAIN = {
+    'skos': ('definitions/conceptschemes', None),
+    'spec': ('specification-elements/defs', None),
+    'owl': ('definitions/profiles', 1),
+}
+
+PREFIXES = """@prefix dcterms: <http://purl.org/dc/terms/> .
+@prefix owl: <http://www.w3.org/2002/07/owl#> .
+@prefix policy: <http://www.opengis.net/def/metamodel/ogc-na/> .
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+@prefix skos: <http://www.w3.org/2004/02/skos/core#> .
+@prefix spec: <http://www.opengis.net/def/ont/modspec/> .
+@prefix specrel: <http://www.opengis.net/def/ont/specrel/> .
+@prefix status: <http://www.opengis.net/def/status/> .
+@prefix xsd: <http://www.w3.org/2001/XMLSchema#> .
+
+"""
+
+STATUSES = ('valid', 'experimental', 'stable', 'superseded')
+
+
+def tree(size, depth, fanout):
+    """ parent index of each of size nodes, filled breadth first - at most depth levels of fanout children under each
+    top node, with as many top nodes as needed
+    @return: list of parent index or None
+    """
+    per_top = sum(fanout ** level for level in range(depth))
+    parents = []
+    for i in range(size):
+        offset = i % per_top
+        top = i - offset
+        parents.append(None if offset == 0 else top + (offset - 1) // fanout)
+    return parents
+
+
+def write_skos(out, size, depth=3, fanout=10, collections=10):
+    """ a concept scheme with a broader hierarchy, and collections - narrower, topConcepts etc are left for
+    entailment, as in the real inputs """
+    base = "http://www.opengis.net/def/synthetic/skos{}".format(size)
+    out.write(PREFIXES)
+    out.write("<{0}> a skos:ConceptScheme ;\n    skos:prefLabel \"Synthetic concept scheme of {1} concepts\"@en ;\n"
+              "    skos:definition \"Generated to test scaling.\"@en ;\n    dcterms:source <{0}/source> .\n\n"
+              .format(base, size))
+    for i, parent in enumerate(tree(size, depth, fanout)):
+        out.write("<{0}/c{1}> a skos:Concept ;\n    skos:inScheme <{0}> ;\n    skos:prefLabel \"concept {1}\"@en ;\n"
+                  "    skos:definition \"Definition of synthetic concept {1}.\"@en ;\n"
+                  "    policy:status status:{2}".format(base, i, STATUSES[i % len(STATUSES)]))
+        if parent is not None:
+            out.write(" ;\n    skos:broader <{}/c{}>".format(base, parent))
+        out.write(" .\n\n")
+    for c in range(collections):
+        members = ", ".join("<{}/c{}>".format(base, i) for i in range(c, size, collections))
+        out.write("<{0}/collection{1}> a skos:Collection ;\n    skos:prefLabel \"collection {1}\"@en ;\n"
+                  "    skos:definition \"Every {2}th concept.\"@en ;\n    skos:member {3} .\n\n"
+                  .format(base, c, collections, members))
+
+
+def write_spec(out, size, depth=2, fanout=10, collections=0):
+    """ a modular specification - requirements classes of fanout requirements ( nested depth deep ), each with a
+    conformance class and tests """
+    doc = "http://www.opengis.net/def/docs/synthetic-{}".format(size)
+    spec = "http://www.opengis.net/spec/synthetic{}/1.0".format(size)
+    out.write(PREFIXES)
+    out.write("<{0}> a spec:Specification ;\n    skos:notation \"synthetic-{2}\" ;\n"
+              "    skos:prefLabel \"Synthetic specification of {2} requirements\" ;\n"
+              "    spec:date \"2020-01-01\"^^xsd:date ;\n    specrel:modspec <{1}> .\n\n"
+              "<{1}> a skos:ConceptScheme ;\n    dcterms:source <{0}> ;\n"
+              "    skos:prefLabel \"Specification elements for synthetic-{2}\" .\n\n".format(doc, spec, size))
+    parents = tree(size, depth, fanout)
+    for i, parent in enumerate(parents):
+        if parent is None:
+            out.write("<{0}/req/rc{1}> a spec:RequirementClass, skos:Concept ;\n"
+                      "    skos:prefLabel \"Requirement Class: {1}\" ;\n"
+                      "    skos:definition \"Synthetic requirements class {1}.\" .\n\n"
+                      "<{0}/conf/rc{1}> a spec:ConformanceClass, skos:Concept ;\n"
+                      "    spec:requirementsTested <{0}/req/rc{1}> ;\n"
+                      "    skos:prefLabel \"Conformance Class: {1}\" .\n\n".format(spec, i))
+            continue
+        rc = i
+        while parents[rc] is not None:
+            rc = parents[rc]
+        out.write("<{0}/req/rc{1}/r{2}> a spec:Requirement, skos:Concept ;\n"
+                  "    skos:prefLabel \"Requirement {2}\" ;\n"
+                  "    skos:definition \"The encoding SHALL satisfy synthetic requirement {2}.\" .\n\n"
+                  "<{0}/req/rc{1}> spec:normativeStatement <{0}/req/rc{1}/r{2}> .\n\n"
+                  "<{0}/conf/rc{1}/t{2}> a spec:ConformanceTest, skos:Concept ;\n"
+                  "    spec:requirement <{0}/req/rc{1}/r{2}> ;\n    spec:testType spec:Capabilities ;\n"
+                  "    spec:method \"Inspect the encoding.\" ;\n    spec:purpose \"Verify requirement {2}.\" ;\n"
+                  "    skos:prefLabel \"ConformanceTest: {2}\" .\n\n".format(spec, rc, i))
+
+
+def write_owl(out, size, depth=4, fanout=5, collections=0):
+    """ an ontology with a subclass hierarchy and an object property for every fanout classes """
+    base = "http://www.opengis.net/def/synthetic/owl{}".format(size)
+    out.write(PREFIXES)
+    out.write("<{0}> a owl:Ontology ;\n    rdfs:label \"Synthetic ontology of {1} classes\" ;\n"
+              "    rdfs:comment \"Generated to test scaling.\" .\n\n".format(base, size))
+    for i, parent in enumerate(tree(size, depth, fanout)):
+        out.write("<{0}#C{1}> a owl:Class ;\n    rdfs:isDefinedBy <{0}> ;\n    rdfs:label \"Class {1}\" ;\n"
+                  "    rdfs:comment \"Synthetic class {1}.\"".format(base, i))
+        if parent is not None:
+            out.write(" ;\n    rdfs:subClassOf <{}#C{}>".format(base, parent))
+        out.write(" .\n\n")
+        if parent is not None and i % fanout == 0:
+            out.write("<{0}#p{1}> a owl:ObjectProperty ;\n    rdfs:isDefinedBy <{0}> ;\n    rdfs:label \"property {1}\" ;\n"
+                      "    rdfs:domain <{0}#C{2}> ;\n    rdfs:range <{0}#C{1}> .\n\n".format(base, i, parent))
+
+
+WRITERS = {'skos': write_skos, 'spec': write_spec, 'owl': write_owl}
+
+
+def generate(kind, size, path, depth=None, fanout=None, collections=None):
+    kwargs = {k: v for k, v in (('depth', depth), ('fanout', fanout), ('collections', collections)) if v is not None}
+    with open(path, "w", encoding="utf-8") as out:
+        WRITERS[kind](out, size, **kwargs)
+
+
+def reset_peak_rss() -> bool:
+    """ start a new high-water mark of this process's resident memory - possible on Linux only
+    @return: whether it was reset """
+    try:
+        with open("/proc/self/clear_refs", "w") as cr:
+            cr.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """ peak resident memory of this process - since the last reset_peak_rss(), where it can be reset - or None where
+    not available """
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB elsewhere
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def measure(kind, path):
+    """ run the pipeline stages on one generated file, in this process - parsing into a temporary cache directory
+    rather than the repository's
+    @return: list of { stage, seconds, peak_rss_mb } - peak_rss_mb is the peak memory of the process during the stage
+    where the high-water mark can be reset ( Linux ), otherwise how much the stage raised the process's peak
+    """
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import update_vocabs
+    scopepath, index = KIND_DOMAIN[kind]
+    cfg = update_vocabs.DOMAIN_CFG[scopepath]
+    if index is not None:
+        cfg = cfg[index]
+    rows = []
+
+    def timed(name, fn):
+        before = None if reset_peak_rss() else peak_rss_mb()
+        start = time.perf_counter()
+        with redirect_stdout(io.StringIO()):
+            result = fn()
+        peak = peak_rss_mb()
+        if peak is not None and before is not None:
+            peak -= before
+        rows.append({'stage': name, 'seconds': time.perf_counter() - start, 'peak_rss_mb': peak})
+        return result
+
+    with tempfile.TemporaryDirectory(prefix="cache") as cachedir:
+        update_vocabs.CACHE_DIR = cachedir
+        extra = timed('closure', lambda: update_vocabs.get_entailed_closure(cfg['extraont'], cfg['rulelist'])
+                      if cfg.get('extraont') else None)
+        g = timed('parse', lambda: update_vocabs.parse_turtle(path))
+        newg = timed('entail', lambda: update_vocabs.perform_entailments(cfg['rulelist'], path, g=g, extra=extra))
+        timed('validate', lambda: update_vocabs.get_validator(cfg['validator']).validate(newg, ont_graph=extra,
+                                                                                          inference='rdfs'))
+        timed('serialize', lambda: update_vocabs.make_rdf(path, g=newg, rootpath=cfg['uri_root_filter']))
+    for row in rows:
+        row['triples'] = len(newg)
+    return rows
+
+
+def scale(kind, sizes, csvpath=None, plotpath=None, depth=None, fanout=None, collections=None):
+    """ generate and measure each size in a separate process, so peak memory is per size """
+    rows = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in sizes:
+            path = os.path.join(workdir, "{}_{}.ttl".format(kind, size))
+            generate(kind, size, path, depth, fanout, collections)
+            result = subprocess.run([sys.executable, os.path.abspath(__file__), "measure", path, "--kind", kind],
+                                    capture_output=True, text=True)
+            if result.returncode:
+                print("Failed to measure {} {} : {}".format(kind, size, result.stderr.strip().splitlines()[-1:]))
+                continue
+            for row in json.loads(result.stdout.strip().splitlines()[-1]):
+                row.update({'kind': kind, 'size': size})
+                rows.append(row)
+                print("{} {:>8} {:10} {:9.3f}s {}".format(kind, size, row['stage'], row['seconds'],
+                                                      "{:.0f}MB".format(row['peak_rss_mb']) if row['peak_rss_mb'] is not None else ""))
+
+    # growth of time with size between successive sizes - above 1 is super-linear
+    for stage in dict.fromkeys(r['stage'] for r in rows):
+        points = [(r['size'], r['seconds']) for r in rows if r['stage'] == stage and r['seconds'] > 0]
+        for (s1, t1), (s2, t2) in zip(points, points[1:]):
+            exponent = math.log(t2 / t1) / math.log(s2 / s1)
+            print("{:10} {:>8} -> {:<8} time ~ size^{:.2f}{}".format(
+                stage, s1, s2, exponent, "  SUPER-LINEAR" if exponent > 1.2 else ""))
+
+    if csvpath:
+        with open(csvpath, "w", newline="") as cf:
+            writer = csv.DictWriter(cf, fieldnames=['kind', 'size', 'triples', 'stage', 'seconds', 'peak_rss_mb'])
+            writer.writeheader()
+            writer.writerows(rows)
+    if plotpath:
+        try:
+            import matplotlib
+            matplotlib.use("Agg")
+            import matplotlib.pyplot as plt
+        except ImportError:
+            print("matplotlib is not installed - no plot written")
+            return rows
+        fig, (timeax, memax) = plt.subplots(1, 2, figsize=(12, 5))
+        for stage in dict.fromkeys(r['stage'] for r in rows):
+            points = [r for r in rows if r['stage'] == stage]
+            timeax.plot([r['size'] for r in points], [r['seconds'] for r in points], marker='o', label=stage)
+            memax.plot([r['size'] for r in points], [r['peak_rss_mb'] or 0 for r in points], marker='o', label=stage)
+        for ax, label in ((timeax, "seconds"), (memax, "peak RSS (MB)")):
+            ax.set_xscale("log")
+            ax.set_yscale("log")
+            ax.set_xlabel("size")
+            ax.set_ylabel(label)
+            ax.legend()
+        fig.suptitle("update_vocabs scaling - {}".format(kind))
+        fig.savefig(plotpath)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "mode",
+        choices=('generate', 'scale', 'measure'),
+        help="generate one file, or measure the pipeline over a range of sizes",
+    )
+    parser.add_argument(
+        "path",
+        nargs='?',
+        help="( measure only ) generated file to run the pipeline on",
+    )
+    parser.add_argument(
+        "--kind",
+        choices=KINDS,
+        default='skos',
+        help="skos concept scheme, modspec specification or owl ontology",
+    )
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=1000,
+        help="number of concepts, requirements or classes to generate",
+    )
+    parser.add_argument(
+        "--sizes",
+        default="1000,10000",
+        help="comma separated sizes to measure - default = 1000,10000",
+    )
+    parser.add_argument(
+        "--depth",
+        type=int,
+        help="levels of the concept, requirement or class hierarchy",
+    )
+    parser.add_argument(
+        "--fanout",
+        type=int,
+        help="children of each node of the hierarchy",
+    )
+    parser.add_argument(
+        "--collections",
+        type=int,
+        help="( skos only ) number of collections",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="file to generate",
+    )
+    parser.add_argument(
+        "--csv",
+        help="write scaling measurements to this CSV file",
+    )
+    parser.add_argument(
+        "--plot",
+        help="plot scaling measurements to this image file ( needs matplotlib )",
+    )
+    args = parser.parse_args()
+
+    if args.mode == 'generate':
+        generate(args.kind, args.size, args.output or "{}_{}.ttl".format(args.kind, args.size),
+                 args.depth, args.fanout, args.collections)
+    elif args.mode == 'measure':
+        print(json.dumps(measure(args.kind, args.path)))
+    else:
+        scale(args.kind, [int(s) for s in args.sizes.split(",")], args.csv, args.plot,
+              args.depth, args.fanout, args.collections)
@@ -0,0 +1,328 @@
+#write a graph as Turtle, deterministically and straight to a stream
+#
+# the layout is that of rdflib's turtle serialiser - prefixes in use, rdfs:Class members, then other subjects by
+# ( blank node, times referenced, IRI ), rdf:type and rdfs:label before other predicates, singly referenced blank
+# nodes nested as [ ... ] and lists as ( ... ) - so outputs only change where the graph does. Unlike rdflib, blank
+# nodes are ordered and labelled by what they describe and what refers to them rather than by their random ids, so
+# the same graph is always written the same way, and nothing is built up in memory before it is written
+#
+# example use:
+#
+# with open("out.ttl", "wb") as out:
+#     write_turtle(g, out)
+
+import hashlib
+import re
+from collections import Counter, defaultdict
+from functools import cmp_to_key
+
+from rdflib import RDF, RDFS, BNode, Literal, URIRef
+
+INDENT = "    "
+
+# predicates written first, in this order
+PREDICATE_ORDER = [RDF.type, RDFS.label]
+
+# subjects written first, before any others
+TOP_CLASSES = [RDFS.Class]
+
+# a % not followed by two hex digits must be escaped in a prefixed name
+PERCENT_ESCAPE = re.compile(r"%(?![0-9A-Fa-f]{2})")
+
+
+def get_bnode_keys(g) -> dict:
+    """ a key for each blank node of a graph, from a hash of what it describes ( following other blank nodes ) and what
+    refers to it - refined by the keys of the blank nodes around it where that is not enough to tell blank nodes apart.
+    Keys are independent of blank node ids, so the same graph always orders and labels its blank nodes the same way
+    @param g: graph
+    @return: { blank node: key }
+    """
+    memo = {}
+
+    def describe(root) -> str:
+        """ digest of what a blank node describes, walking the blank nodes it refers to depth first with a stack
+        rather than by recursion, so long lists cannot overflow Python's. A blank node met again on the path to it is
+        described as a "cycle" - digests of nodes whose description was so cut short depend on where they were entered,
+        so are not memoised """
+        if root in memo:
+            return memo[root]
+        # [ blank node, ( predicate, object ) pairs still to describe, parts described, whether a cycle was cut short ]
+        stack = [[root, list(g.predicate_objects(root)), [], False]]
+        path = {root}
+        while True:
+            frame = stack[-1]
+            b, pending, parts = frame[:3]
+            while pending:
+                p, o = pending[-1]
+                if isinstance(o, BNode) and o not in memo and o not in path:
+                    break
+                pending.pop()
+                if not isinstance(o, BNode):
+                    parts.append(p.n3() + " " + o.n3())
+                elif o in memo:
+                    parts.append(p.n3() + " " + memo[o])
+                else:
+                    parts.append(p.n3() + " cycle")
+                    frame[3] = True
+            if pending:
+                o = pending[-1][1]
+                stack.append([o, list(g.predicate_objects(o)), [], False])
+                path.add(o)
+                continue
+            digest = hashlib.sha1("\n".join(sorted(parts)).encode("utf-8")).hexdigest()
+            stack.pop()
+            path.discard(b)
+            if not frame[3]:
+                memo[b] = digest
+            if not stack:
+                return digest
+            parent = stack[-1]
+            parent[2].append(parent[1].pop()[0].n3() + " " + digest)
+            parent[3] = parent[3] or frame[3]
+
+    def render(b, keys) -> str:
+        """ the triples a blank node is in, as sorted N-Triples with blank nodes labelled by their keys """
+        def term(t):
+            return "_:" + keys[t] if isinstance(t, BNode) else t.n3()
+        return "\n".join(sorted(["{} {} {} .".format(term(b), p.n3(), term(o)) for p, o in g.predicate_objects(b)] +
+                                ["{} {} {} .".format(term(s), p.n3(), term(b)) for s, p in g.subject_predicates(b)]))
+
+    bnodes = set(s for s in g.subjects() if isinstance(s, BNode)) | \
+             set(o for o in g.objects() if isinstance(o, BNode))
+    keys = {}
+    for b in bnodes:
+        incoming = sorted(("[]" if isinstance(s, BNode) else s.n3()) + " " + p.n3()
+                          for s, p in g.subject_predicates(b))
+        keys[b] = hashlib.sha1(
+            (describe(b) + "\n" + "\n".join(incoming)).encode("utf-8")).hexdigest()
+    counts = Counter(keys.values())
+    if len(counts) < len(keys):
+        # blank nodes describing the same thing from blank nodes - e.g. the same organisation as the affiliation of
+        # two people - are told apart by the keys of the blank nodes around them, until that tells no more apart.
+        # Any still sharing a key are in the same triples, so whichever is labelled first the output is the same
+        refined = keys
+        while True:
+            previous = refined
+            refined = {b: hashlib.sha1(render(b, previous).encode("utf-8")).hexdigest() for b in bnodes}
+            if len(set(refined.values())) == len(set(previous.values())):
+                break
+        # those told apart by what they describe and what refers to them keep those keys
+        keys = {b: key if counts[key] == 1 else previous[b] for b, key in keys.items()}
+    return keys
+
+
+def compare_terms(keys):
+    """ rdflib's ordering of terms, except blank nodes are compared by their keys rather than ids """
+    def compare(a, b):
+        if isinstance(a, BNode) and isinstance(b, BNode):
+            a, b = keys[a], keys[b]
+        return -1 if a < b else 1 if b < a else 0
+    return cmp_to_key(compare)
+
+
+class TurtleWriter:
+    """ writes one graph - see write_turtle() """
+
+    def __init__(self, g, stream, encoding="utf-8"):
+        self.g = g
+        self.stream = stream
+        self.encoding = encoding
+        self.namespaces = {}
+        self.rewrites = {}
+        self.pnames = {}
+        self.references = defaultdict(int)
+        self.subjects = {}
+        self.done = set()
+        self.keys = get_bnode_keys(g)
+        self.order = compare_terms(self.keys)
+        # labels of blank nodes written more than once - given as they are first written, so that where keys collide
+        # they are numbered in the order written
+        self.labels = {}
+        self.used = set()
+
+    def write(self, text: str):
+        self.stream.write(text.encode(self.encoding, "replace"))
+
+    def add_namespace(self, prefix, namespace) -> str:
+        """ record a prefix as used - renaming prefixes turtle does not allow, or that clash """
+        if (prefix > "" and prefix[0] == "_") or self.namespaces.get(prefix, namespace) != namespace:
+            if prefix not in self.rewrites:
+                p = "p" + prefix
+                while p in self.namespaces:
+                    p = "p" + p
+                self.rewrites[prefix] = p
+            prefix = self.rewrites[prefix]
+        self.namespaces[prefix] = namespace
+        return prefix
+
+    def pname(self, uri, generate=False):
+        """ prefixed name of an IRI, or None if it has none
+        @param generate: bind a new prefix ( ns1, ns2 ... ) if there is none for the IRI's namespace - done for
+        predicates, as rdflib does
+        """
+        if not isinstance(uri, URIRef):
+            return None
+        if (uri, generate) in self.pnames:
+            return self.pnames[(uri, generate)]
+        try:
+            prefix, namespace, local = self.g.namespace_manager.compute_qname(uri, generate=generate)
+        except Exception:
+            prefix = self.g.namespace_manager.store.prefix(uri)
+            namespace, local = uri, ""
+        pname = None
+        if prefix is not None:
+            local = PERCENT_ESCAPE.sub("\\%", local.replace("(", r"\(").replace(")", r"\)"))
+            if not local.endswith("."):
+                pname = "{}:{}".format(self.add_namespace(prefix, namespace), local)
+        self.pnames[(uri, generate)] = pname
+        return pname
+
+    def label(self, node, verb=False) -> str:
+        if node == RDF.nil:
+            return "()"
+        if verb and node == RDF.type:
+            return "a"
+        if isinstance(node, Literal):
+            return node._literal_n3(use_plain=True, qname_callback=lambda dt: self.pname(dt))
+        if isinstance(node, BNode):
+            if node not in self.labels:
+                label = "b" + self.keys[node][:16]
+                n = 1
+                while label in self.used:
+                    n += 1
+                    label = "b{}_{}".format(self.keys[node][:16], n)
+                self.labels[node] = label
+                self.used.add(label)
+            return "_:" + self.labels[node]
+        return self.pname(node, verb) or node.n3()
+
+    def preprocess(self):
+        """ count references to each node, and find the prefixes in use - which are written first. Prefixes are
+        generated for predicates in sorted order, so they are numbered the same way every time """
+        predicates = set()
+        for s, p, o in self.g:
+            self.references[o] += 1
+            self.subjects[s] = True
+            predicates.add(p)
+        for p in sorted(predicates - {RDF.type}):
+            self.pname(p, True)
+        for s, p, o in self.g:
+            for node in (s, o):
+                self.pname(node)
+            if isinstance(o, Literal) and o.datatype:
+                self.pname(o.datatype)
+
+    def ordered_subjects(self):
+        seen = set()
+        for cls in TOP_CLASSES:
+            members = sorted(self.g.subjects(RDF.type, cls), key=self.order)
+            seen.update(members)
+            yield from members
+        rest = [s for s in self.subjects if s not in seen]
+        rest.sort(key=lambda s: (isinstance(s, BNode), self.references[s], self.keys[s] if isinstance(s, BNode) else s))
+        yield from rest
+
+    def is_list(self, node) -> bool:
+        """ whether node is a well formed RDF list with nothing else said about its nodes """
+        if self.g.value(node, RDF.first) is None:
+            return False
+        while node:
+            if node != RDF.nil and len(list(self.g.predicate_objects(node))) != 2:
+                return False
+            node = self.g.value(node, RDF.rest)
+        return True
+
+    def object(self, node, depth, newline=False):
+        if not isinstance(node, BNode) or node in self.done or self.references[node] > 1:
+            self.write(("" if newline else " ") + self.label(node))
+            return
+        if not newline:
+            self.write(" ")
+        if self.is_list(node):
+            self.write("(")
+            while node:
+                item = self.g.value(node, RDF.first)
+                if item is not None:
+                    self.object(item, depth + 1)
+                    self.done.add(node)
+                node = self.g.value(node, RDF.rest)
+            self.write(" )")
+        else:
+            self.done.add(node)
+            self.write("[")
+            self.predicates(node, depth + 1)
+            self.write(" ]")
+
+    def predicates(self, subject, depth):
+        properties = {}
+        for p, o in self.g.predicate_objects(subject):
+            properties.setdefault(p, []).append(o)
+        if not properties:
+            return
+        for objects in properties.values():
+            objects.sort(key=self.order)
+        first = [p for p in PREDICATE_ORDER if p in properties]
+        for i, p in enumerate(first + sorted(p for p in properties if p not in first)):
+            if i:
+                self.write(" ;\n" + INDENT * (depth + 1))
+            self.write(("" if i else " ") + self.label(p, verb=True))
+            objects = properties[p]
+            self.object(objects[0], depth + 1)
+            for o in objects[1:]:
+                self.write(",\n" + INDENT * (depth + 2))
+                self.object(o, depth + 1, newline=True)
+
+    def statement(self, subject):
+        self.done.add(subject)
+        if isinstance(subject, BNode) and not self.references[subject]:
+            self.write("\n[]")
+        else:
+            self.write("\n" + self.label(subject))
+        self.predicates(subject, 0)
+        self.write(" .\n")
+
+    def run(self):
+        self.preprocess()
+        for prefix, namespace in sorted(self.namespaces.items()):
+            self.write("@prefix {}: <{}> .\n".format(prefix, namespace))
+        for subject in self.ordered_subjects():
+            if subject not in self.done:
+                self.statement(subject)
+        self.write("\n")
+
+
+def write_turtle(g, stream, encoding="utf-8"):
+    """ write a graph as Turtle - the same graph always gives the same bytes
+    @param g: rdflib Graph - prefixes are taken from its namespace manager
+    @param stream: binary stream to write to
+    """
+    TurtleWriter(g, stream, encoding).run()
+
+
+def check_long_list(n=3000):
+    """ round-trip a graph holding an RDF list of n items - longer than Python's recursion limit - through each
+    deterministic writer, checking the list read back has the same items and that writing it again gives the same
+    bytes """
+    import io
+    from rdflib import Graph
+    from rdflib.collection import Collection
+    from rdfxml_writer import write_rdfxml
+    subject = URIRef("http://example.org/list")
+    items = [Literal(i) for i in range(n)]
+    g = Graph()
+    head = BNode()
+    Collection(g, head, items)
+    g.add((subject, RDFS.member, head))
+    for writer, fmt in ((write_turtle, "turtle"), (write_rdfxml, "xml")):
+        out = io.BytesIO()
+        writer(g, out)
+        back = Graph().parse(data=out.getvalue(), format=fmt)
+        assert len(back) == len(g) and list(Collection(back, back.value(subject, RDFS.member))) == items, fmt
+        again = io.BytesIO()
+        writer(back, again)
+        assert out.getvalue() == again.getvalue(), fmt
+        print("{}: list of {} items round-trips".format(fmt, n))
+
+
+if __name__ == "__main__":
+    check_long_list()
@@ -1,31 +1,50 @@
 
+from __future__ import annotations
+
+import filecmp
+import gzip
+import hashlib
+import io
 import json
+import logging
+import marshal
+import multiprocessing
+import re
+import shutil
+import threading
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, redirect_stdout
+from functools import partial
 from glob import glob
-from typing import List
+from typing import List, TYPE_CHECKING
 import argparse
 from pathlib import Path
 from urllib.parse import urlencode, quote_plus
-
-import httpx
-from pyshacl import validate
-from rdflib import Graph, URIRef
-from rdflib.namespace import RDF, SKOS
 import os
 
+# httpx, pyshacl and rdflib are slow to import - they are imported by the functions that use them,
+# so -h and runs with nothing to do start quickly
+if TYPE_CHECKING:
+    import httpx
+    from rdflib import Graph, URIRef
+
 
 def get_closure_graph( vlist: List[str] ):
+    from rdflib import Graph
     g = Graph()
     for v in vlist:
         if v.startswith("http:") or v.startswith("https:"):
+            import httpx
             r = httpx.get(v)
             assert r.status_code == 200
             data = r.text
             g += Graph().parse(data=data, format="turtle")
         else:
-            g += Graph().parse(source=v, format="turtle")
+            g += parse_turtle(v)
 
     return g
-
 SKOS_RULES = [ 'scripts/skosbasics.shapes.ttl', 'scripts/ogc_skos_profile_entailments.ttl', 'scripts/skos_vocprez.shapes.ttl' ]
 #COMMON_VALIDATORS = [ "https://w3id.org/profile/vocpub/validator" ]
 COMMON_VALIDATORS = [ 'scripts/vocprez.shapes.ttl' ]
@@ -48,10 +67,11 @@ APPSCHEMA_CLOSURE = [ 'definitions/models/featuretypes.ttl' ]
 
 # SPECMODEL_CLOSURE = [ 'scripts/modspecs_entailmenthelpers.ttl']
 
-SKOS_VALIDATOR = get_closure_graph ( COMMON_VALIDATORS  )
-SPEC_VALIDATOR =  get_closure_graph ( SPEC_VALIDATORS  ) + SKOS_VALIDATOR
+# validators are lists of shapes files - see get_validator()
+SKOS_VALIDATOR = COMMON_VALIDATORS
+SPEC_VALIDATOR = SPEC_VALIDATORS + SKOS_VALIDATOR
 #DOCREGISTER_GRAPH = get_closure_graph( DOCREG_CLOSURE )
-TEST_VALIDATOR = get_closure_graph([ 'scripts/test/test_validator.ttl'])
+TEST_VALIDATOR = [ 'scripts/test/test_validator.ttl' ]
 
 DOMAIN_CFG = {}
 
@@ -159,50 +179,230 @@ except:
 
 REPO = 'ogc-na'
 
-def load_vocab(vocab: Path, guri):
-    authdetails = None
-    try:
-        authdetails = (os.environ["DB_USERNAME"], os.environ["DB_PASSWORD"])
-    except:
-        pass
-    context = "{}/rdf4j-server/repositories/{}/statements?context=<{}>".format(RDF4JSERVER, REPO, quote_plus(guri))
+# bounded number of concurrent uploads sharing one pool of keep-alive connections
+UPLOAD_CONCURRENCY = 4
+UPLOAD_RETRIES = 3
+UPLOAD_BACKOFF = 0.5
 
+_HTTP_CLIENT = None
+# upload threads may ask for the client at the same time - only one may create it
+_HTTP_CLIENT_LOCK = threading.Lock()
 
-    r = httpx.delete(
-        # "http://"+os.environ["VOCAB_HOST"] + "/rdf4j-server/repositories/ogc-na" ,
-        context,
-        auth=authdetails
-    )
-    # print ( r.status_code )
-    r = httpx.post(
-    #"http://"+os.environ["VOCAB_HOST"] + "/rdf4j-server/repositories/ogc-na" ,
-    context,
-    params={"graph":  guri },
-    headers={"Content-Type": "application/x-turtle;charset=UTF-8"},
-    content=open(vocab, "rb").read(),
-    auth= authdetails
-    )
-    assert 200 <= r.status_code <= 300, "Status code was {}".format(r.status_code)
-    # add_to_vocab_index(vocab, get_graph_uri_for_vocab(vocab))
+
+def get_http_client() -> httpx.Client:
+    """ the shared, connection pooled client used for all triplestore requests """
+    global _HTTP_CLIENT
+    with _HTTP_CLIENT_LOCK:
+        if _HTTP_CLIENT is not None:
+            return _HTTP_CLIENT
+        import httpx
+        authdetails = None
+        try:
+            authdetails = (os.environ["DB_USERNAME"], os.environ["DB_PASSWORD"])
+        except:
+            pass
+        _HTTP_CLIENT = httpx.Client(
+            auth=authdetails,
+            timeout=httpx.Timeout(60.0, connect=10.0),
+            limits=httpx.Limits(max_connections=UPLOAD_CONCURRENCY, max_keepalive_connections=UPLOAD_CONCURRENCY))
+        return _HTTP_CLIENT
+
+
+def rdf4j_request(method, url, body_path=None, **kwargs) -> httpx.Response:
+    """ make a triplestore request, retrying connection failures and 5xx responses with exponential backoff
+    @param body_path: file to stream as the request body - reopened for each attempt
+    """
+    import httpx
+    for attempt in range(UPLOAD_RETRIES + 1):
+        try:
+            with stage('http', method=method, url=url, attempt=attempt) as span:
+                if body_path:
+                    with open(body_path, "rb") as body:
+                        r = get_http_client().request(method, url, content=body, **kwargs)
+                else:
+                    r = get_http_client().request(method, url, **kwargs)
+                span['status'] = r.status_code
+            if r.status_code < 500 or attempt == UPLOAD_RETRIES:
+                assert 200 <= r.status_code <= 300, "Status code was {} for {} {}".format(r.status_code, method, url)
+                return r
+        except httpx.TransportError:
+            if attempt == UPLOAD_RETRIES:
+                raise
+        time.sleep(UPLOAD_BACKOFF * 2 ** attempt)
+
+
+def load_vocab(vocab: Path, guri, content_hash=None):
+    """ replace the content of named graph guri with a turtle file, in a single RDF4J transaction so the graph
+    is never seen empty - and remember what was uploaded, for later delta uploads
+    @param content_hash: recorded in the graph as a CONTENT_HASH triple - see get_uploaded_hash()
+    """
+    import httpx
+    repository = "{}/rdf4j-server/repositories/{}".format(RDF4JSERVER, REPO)
+    context = "{}/statements?context=<{}>".format(repository, quote_plus(guri))
+    txn = rdf4j_request("POST", repository + "/transactions").headers["Location"]
+    try:
+        rdf4j_request("PUT", txn, params={"action": "UPDATE", "update": "CLEAR SILENT GRAPH <{}>".format(guri)})
+        rdf4j_request("PUT", txn, body_path=vocab,
+                      params={"action": "ADD", "context": "<{}>".format(guri)},
+                      headers={"Content-Type": "application/x-turtle;charset=UTF-8"})
+        if content_hash:
+            rdf4j_request("PUT", txn, params={"action": "UPDATE", "update": 'INSERT DATA {{ GRAPH <{0}> {{ <{0}> <{1}> "{2}" }} }}'
+                          .format(guri, CONTENT_HASH, content_hash)})
+        rdf4j_request("PUT", txn, params={"action": "COMMIT"})
+    except Exception:
+        try:
+            get_http_client().delete(txn)
+        except httpx.HTTPError:
+            pass
+        raise
+    save_uploaded_graph(guri, parse_turtle(vocab), content_hash)
     return context
 
 
+# predicate of the content hash of the file a shared annotation graph was loaded from
+CONTENT_HASH = 'urn:x-ogcna:contentHash'
+
+
+def get_annotation_graph(annotation) -> str:
+    """ the named graph an annotation file is uploaded to - shared by every file and domain it annotates """
+    return "urn:x-ogcna:annotations:" + Path(annotation).as_posix()
 
-def remove_vocabs(vocabs: List[Path], mappings: dict):
-    for vocab in vocabs:
-        r = httpx.post(
-            "http://defs-dev.opengis,net:8080/rdf4j-server/repositories/ogc-na",
-            data={"update": "DROP GRAPH <{}>".format(mappings[vocab.name])},
-            auth=(os.environ["DB_USERNAME"], os.environ["DB_PASSWORD"])
-        )
-        assert 200 <= r.status_code <= 300, "Status code was {}".format(r.status_code)
-        # remove_from_vocab_index(vocab)
+
+def get_legacy_annotation_graphs(gname, annotations, recorded=()) -> list:
+    """ the graphs a file's annotations were uploaded to before they had shared graphs - its graph name followed by
+    a number, as the old upload loop made them - so they can be dropped. Annotation triples uploaded that way stay
+    in the triplestore until then
+    @param annotations: the annotation files of the file's domain
+    @param recorded: graphs in use - see get_recorded_graphs() - which are never given, whatever their name
+    """
+    graphs = []
+    for n in range(len(annotations)):
+        gname = gname + str(n + 1) if n == 0 else gname[:-1] + str(n + 1)
+        if gname not in recorded:
+            graphs.append(gname)
+    return graphs
+
+
+def get_uploaded_hash(guri):
+    """ the content hash recorded in a graph when it was loaded, or None """
+    r = rdf4j_request("GET", "{}/rdf4j-server/repositories/{}".format(RDF4JSERVER, REPO),
+                      params={"query": "SELECT ?h WHERE {{ GRAPH <{0}> {{ <{0}> <{1}> ?h }} }}".format(guri, CONTENT_HASH)},
+                      headers={"Accept": "application/sparql-results+json"})
+    bindings = r.json()['results']['bindings']
+    return bindings[0]['h']['value'] if bindings else None
+
+
+def upload_annotation(annotation) -> str:
+    """ load an annotation file into its shared graph, unless the graph already holds the same content """
+    guri = get_annotation_graph(annotation)
+    try:
+        with stage('upload', file=annotation, graph=guri) as span:
+            content_hash = get_file_hash(annotation)
+            span['unchanged'] = get_uploaded_hash(guri) == content_hash
+            if span['unchanged']:
+                return "Unchanged {} in {}".format(annotation, guri)
+            load_vocab(annotation, guri, content_hash=content_hash)
+            return "Uploaded {} to   {} ".format(annotation, guri)
+    except Exception as e:
+        return "Failed to upload {} : ( {} )".format(annotation, e)
+
+
+# where run-to-run caches ( e.g. the last uploaded version of each graph ) are kept
+CACHE_DIR = os.environ.get("NA_CACHE_DIR", ".cache")
+
+
+def get_upload_cache_path(guri) -> Path:
+    key = hashlib.sha256("{} {} {}".format(RDF4JSERVER, REPO, guri).encode()).hexdigest()
+    return Path(CACHE_DIR) / "uploaded" / (key + ".nt")
+
+
+def get_uploaded_graph(guri) -> Graph:
+    """ the last uploaded content of a named graph - from the local cache, or fetched from the triplestore """
+    from rdflib import Graph
+    cached = get_upload_cache_path(guri)
+    if cached.exists():
+        return Graph().parse(str(cached), format="nt")
+    r = rdf4j_request("GET", "{}/rdf4j-server/repositories/{}".format(RDF4JSERVER, REPO),
+                      params={"query": "CONSTRUCT { ?s ?p ?o } WHERE { GRAPH <%s> { ?s ?p ?o } }" % guri},
+                      headers={"Accept": "application/n-triples"})
+    return Graph().parse(data=r.text, format="nt")
+
+
+def save_uploaded_graph(guri, g: Graph, content_hash=None):
+    """ cache what was uploaded to a named graph - see get_uploaded_graph() """
+    from rdflib import Literal, URIRef
+    cached = get_upload_cache_path(guri)
+    cached.parent.mkdir(parents=True, exist_ok=True)
+    if content_hash:
+        g.add((URIRef(guri), URIRef(CONTENT_HASH), Literal(content_hash)))
+    g.serialize(destination=str(cached), format="nt", encoding="utf-8")
+
+
+def get_bnode_triples(g: Graph) -> set:
+    """ the triples of g with blank nodes, with each blank node replaced by a key from its content - so they can be
+    compared between graphs whatever the blank node ids """
+    from rdflib import BNode
+    from turtle_writer import get_bnode_keys
+    keys = get_bnode_keys(g)
+    return set(tuple("_:" + keys[term] if isinstance(term, BNode) else term for term in t)
+               for t in g if any(isinstance(term, BNode) for term in t))
+
+
+def load_vocab_delta(vocab: Path, guri):
+    """ bring named graph guri up to date with a turtle file by sending only the changed triples as
+    DELETE DATA / INSERT DATA. Blank nodes are compared by content, as their ids differ between uploads; if any
+    triples with blank nodes have changed the whole graph is replaced, as they cannot be deleted by id.
+    @return: ( context, ( number of triples removed, number of triples added ) or None if the graph was replaced )
+    """
+    from rdflib import BNode
+    newg = parse_turtle(vocab)
+    oldg = get_uploaded_graph(guri)
+    if get_bnode_triples(oldg) != get_bnode_triples(newg):
+        return load_vocab(vocab, guri), None
+    # blank node triples are unchanged - only the others need comparing
+    oldt = set(t for t in oldg if not any(isinstance(term, BNode) for term in t))
+    newt = set(t for t in newg if not any(isinstance(term, BNode) for term in t))
+    removed = oldt - newt
+    added = newt - oldt
+    delta = (len(removed), len(added))
+    context = "{}/rdf4j-server/repositories/{}/statements?context=<{}>".format(RDF4JSERVER, REPO, quote_plus(guri))
+    updates = []
+    if removed:
+        updates.append("DELETE DATA { GRAPH <%s> {\n%s\n} }" % (guri, "\n".join(
+            "{} {} {} .".format(*(term.n3() for term in t)) for t in removed)))
+    if added:
+        updates.append("INSERT DATA { GRAPH <%s> {\n%s\n} }" % (guri, "\n".join(
+            "{} {} {} .".format(*(term.n3() for term in t)) for t in added)))
+    if updates:
+        rdf4j_request("POST", "{}/rdf4j-server/repositories/{}/statements".format(RDF4JSERVER, REPO),
+                      content=" ;\n".join(updates).encode("utf-8"),
+                      headers={"Content-Type": "application/sparql-update;charset=UTF-8"})
+    save_uploaded_graph(guri, newg)
+    return context, delta
+
+
+def remove_vocabs(vocabs: List[Path], mappings: dict, keep=()) -> List[str]:
+    """ drop the graphs of a list of vocabularies - including their annotation graphs - in one SPARQL update
+    @param mappings: { vocab path : graph URIs } - as recorded in the domain manifests, see get_manifest_entry()
+    @param keep: graphs not to drop - e.g. uploaded again from a renamed file
+    @return: graphs dropped
+    """
+    graphs = [g for g in dict.fromkeys(g for v in vocabs for g in mappings.get(Path(v).as_posix(), []))
+              if g not in keep]
+    if graphs:
+        rdf4j_request("POST", "{}/rdf4j-server/repositories/{}/statements".format(RDF4JSERVER, REPO),
+                      content=" ;\n".join("DROP SILENT GRAPH <{}>".format(g) for g in graphs).encode("utf-8"),
+                      headers={"Content-Type": "application/sparql-update;charset=UTF-8"})
+    for g in graphs:
+        get_upload_cache_path(g).unlink(missing_ok=True)
+    return graphs
 
 
 def get_graph_uri_for_vocab(vocab: Path, g: Graph = None) -> URIRef:
     """We can get the Graph URI for a vocab using assumption that the ConceptScheme is declared in the graph being processed."""
+    from rdflib.namespace import RDF, SKOS
     if not g:
-        g = Graph().parse(str(vocab), format="ttl")
+        g = parse_turtle(vocab)
     for s in g.subjects(predicate=RDF.type, object=SKOS.ConceptScheme):
         yield str(s)
 
@@ -216,22 +416,244 @@ def get_all_vocabs_uris(vocabs: List[Path]) -> dict:
     return mappings
 
 
-# def add_to_vocab_index(file_path: Path, graph_uri: URIRef):
-#     i = Path(__file__).parent.parent / "vocabularies" / "index.json"
-#     with open(i, "r") as f:
-#         mappings = json.load(f)
-#     with open(i, "w") as f:
-#         mappings[str(file_path)] = str(graph_uri)
-#         f.write(json.dumps(mappings))
-#
-#
-# def remove_from_vocab_index(file_path: Path):
-#     i = Path(__file__).parent.parent / "vocabularies" / "index.json"
-#     with open(i, "r") as f:
-#         mappings = json.load(f)
-#     del mappings[str(file_path)]
-#     with open(i, "w") as f:
-#         f.write(json.dumps(mappings))
+MANIFEST_NAME = 'manifest.json'
+# build times of a domain's files, next to its manifest
+SECONDS_NAME = 'seconds.json'
+
+
+def get_manifest_path(scopepath):
+    return os.path.join(scopepath, 'entailed', MANIFEST_NAME)
+
+
+def load_manifest(scopepath) -> dict:
+    """ load the build manifest for a domain - maps each source file to the hashes of the inputs its entailed
+    outputs were built from """
+    try:
+        with open(get_manifest_path(scopepath), "r") as mf:
+            return json.load(mf)
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(scopepath, manifest: dict):
+    Path(get_manifest_path(scopepath)).parent.mkdir(parents=True, exist_ok=True)
+    with open(get_manifest_path(scopepath), "w") as mf:
+        json.dump(manifest, mf, indent=1, sort_keys=True)
+        mf.write("\n")
+
+
+_HASH_CACHE = {}
+
+
+def get_file_hash(v) -> str:
+    """ content hash of a file - remote resources are identified by URL only """
+    v = str(v)
+    if v not in _HASH_CACHE:
+        if v.startswith("http:") or v.startswith("https:"):
+            _HASH_CACHE[v] = "url:" + v
+        else:
+            with open(v, "rb") as hf:
+                _HASH_CACHE[v] = hashlib.sha256(hf.read()).hexdigest()
+    return _HASH_CACHE[v]
+
+
+def get_build_inputs(f, cfg) -> dict:
+    """ hashes of everything the entailed outputs of f depend on : the source file, its rulelist, validator and
+    closure ontologies """
+    inputs = {}
+    for v in [f] + cfg['rulelist'] + cfg['validator'] + (cfg.get('extraont') or []):
+        inputs[Path(v).as_posix()] = get_file_hash(v)
+    return inputs
+
+
+def get_manifest_entry(f, cfg, loadable_path, gname) -> dict:
+    """ what the manifest records of a build - its inputs, output and the graphs it is uploaded to. Only what is the
+    same for the same build, so an unchanged build leaves the committed manifest unchanged
+    @param gname: graph name of the entailed output - see process_file()
+    """
+    return {'inputs': get_build_inputs(f, cfg), 'output': Path(loadable_path).as_posix(),
+            'graphs': [g for _, _, g in get_uploads(f, loadable_path, gname)]}
+
+
+def get_build_seconds_path(scopepath):
+    return os.path.join(scopepath, 'entailed', SECONDS_NAME)
+
+
+def load_build_seconds(scopepath) -> dict:
+    """ how long each file of a domain took in the last batch build that built it - { file: seconds }. The times are
+    committed with the outputs, so every shard of a batch estimates costs from the same times """
+    try:
+        with open(get_build_seconds_path(scopepath), "r") as sf:
+            return json.load(sf)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_build_seconds(scopepath, seconds: dict):
+    """ record build times of a domain - only done by batch builds that are not sharded, as times differ from run to
+    run and so would change the committed file each time """
+    Path(get_build_seconds_path(scopepath)).parent.mkdir(parents=True, exist_ok=True)
+    with open(get_build_seconds_path(scopepath), "w") as sf:
+        json.dump(seconds, sf, indent=1, sort_keys=True)
+        sf.write("\n")
+
+
+def is_up_to_date(f, cfg, manifest: dict) -> bool:
+    entry = manifest.get(Path(f).as_posix())
+    return bool(entry) and entry.get('inputs') == get_build_inputs(f, cfg) \
+        and bool(entry.get('output')) and os.path.exists(entry['output'])
+
+
+def get_domain_files(domain=None):
+    """ ( scopepath, cfg, file ) for every file of every domain - or of one domain """
+    for scopepath, cfglist in DOMAIN_CFG.items():
+        if domain and domain != scopepath:
+            continue
+        for cfg in cfglist if isinstance(cfglist, list) else [cfglist]:
+            for f in sorted(glob(scopepath + cfg['glob'])):
+                yield scopepath, cfg, os.path.normpath(f)
+
+
+def get_domain_inputs(cfg) -> List[str]:
+    """ local files every file of a domain depends on : its rules, validator, closure and annotations """
+    inputs = cfg['rulelist'] + cfg['validator'] + (cfg.get('extraont') or []) + (cfg.get('annotations') or [])
+    return [os.path.normpath(v) for v in inputs if not (v.startswith("http:") or v.startswith("https:"))]
+
+
+def get_ontology_iris(v) -> set:
+    """ IRIs of the ontologies and concept schemes a turtle file declares - what other files owl:imports """
+    from rdflib.namespace import OWL, RDF, SKOS
+    try:
+        g = parse_turtle(v)
+    except Exception as e:
+        log("Warning - cannot parse {} for its owl:imports dependents : {}".format(v, str(e).splitlines()[0]))
+        return set()
+    return set(str(s) for c in (OWL.Ontology, SKOS.ConceptScheme) for s in g.subjects(RDF.type, c))
+
+
+def get_owl_imports(files) -> dict:
+    """ { file : IRIs it owl:imports } for the files importing anything """
+    from rdflib.namespace import OWL
+    imports = {}
+    for f in files:
+        try:
+            with open(f, encoding="utf-8", errors="replace") as tf:
+                if 'imports' not in tf.read():
+                    continue
+            imports[f] = set(str(o) for o in parse_turtle(f).objects(None, OWL.imports))
+        except Exception as e:
+            log("Warning - cannot parse {} for its owl:imports : {}".format(f, str(e).splitlines()[0]))
+    return imports
+
+
+def get_dependents(changed: List[str]) -> List[str]:
+    """ the domain files to re-entail and re-upload when a set of files changes - changed domain files, files whose
+    domain rules, validator, closure or annotations changed, and files owl:importing ( transitively ) an ontology
+    or concept scheme declared by a changed file, or by a closure or annotation file importing one.
+    Only changed files and files that import something are parsed.
+    @param changed: changed - or removed - files, relative to the repository root
+    @return: sorted list of domain files
+    """
+    domainfiles = {f: get_domain_inputs(cfg) for _, cfg, f in get_domain_files()}
+    candidates = set(domainfiles) | set(v for inputs in domainfiles.values() for v in inputs)
+    imports = get_owl_imports(sorted(f for f in candidates if os.path.exists(f)))
+    # files whose content, or whose imports closure, changed
+    affected = set(os.path.normpath(f) for f in changed)
+    frontier = [f for f in affected if os.path.exists(f)]
+    while frontier:
+        declared = set().union(*(get_ontology_iris(f) for f in frontier))
+        frontier = [f for f, iris in imports.items() if f not in affected and iris & declared]
+        affected.update(frontier)
+    return sorted(f for f, inputs in domainfiles.items() if f in affected or affected.intersection(inputs))
+
+
+# parsed turtle files are cached under CACHE_DIR as a term dictionary plus an array of integer triples,
+# keyed by file content hash - loading these is several times faster than parsing turtle
+PARSE_CACHE = True
+PARSE_CACHE_VERSION = 1
+
+
+def get_parse_cache_path(v) -> Path:
+    """ keyed by content and location - relative IRIs are resolved against the file's path when it is parsed, so the
+    same content elsewhere ( e.g. a copy in a temporary directory ) parses to a different graph """
+    key = hashlib.sha256("{} {}".format(get_file_hash(v), os.path.abspath(v)).encode()).hexdigest()
+    return Path(CACHE_DIR) / "parsed" / (key + ".bin")
+
+
+def _dump_graph(g: Graph, ordered) -> bytes:
+    """ @param ordered: the triples of g in the order they were parsed - rule and shape order depend on it """
+    from rdflib import BNode, URIRef
+    ids = {}
+    terms = []
+    triples = array('I')
+    for t in dict.fromkeys(ordered):
+        for term in t:
+            i = ids.get(term)
+            if i is None:
+                i = ids[term] = len(terms)
+                if isinstance(term, URIRef):
+                    terms.append((0, str(term), None, None))
+                elif isinstance(term, BNode):
+                    terms.append((1, str(term), None, None))
+                else:
+                    terms.append((2, str(term), str(term.datatype) if term.datatype else None, term.language))
+            triples.append(i)
+    return marshal.dumps((PARSE_CACHE_VERSION, [(p, str(ns)) for p, ns in g.namespaces()], terms, triples.tobytes()))
+
+
+def _load_graph(data: bytes) -> Graph:
+    from rdflib import BNode, Graph, Literal, URIRef
+    version, namespaces, terms, triplebytes = marshal.loads(data)
+    assert version == PARSE_CACHE_VERSION, "Parse cache version {}".format(version)
+    # fresh blank nodes each load, as parsing would give
+    nodes = [URIRef(v) if kind == 0 else BNode() if kind == 1 else
+             Literal(v, lang=lang, datatype=URIRef(dt) if dt else None) for kind, v, dt, lang in terms]
+    triples = array('I')
+    triples.frombytes(triplebytes)
+    g = Graph()
+    for prefix, ns in namespaces:
+        g.bind(prefix, ns, override=True, replace=True)
+    it = iter(triples)
+    g.addN((nodes[s], nodes[p], nodes[o], g) for s, p, o in zip(it, it, it))
+    return g
+
+
+def parse_turtle(v) -> Graph:
+    """ parse a local turtle file, using the parse cache if enabled
+    @return: a new Graph the caller may modify
+    """
+    with stage('parse', file=Path(v).as_posix()):
+        return _parse_turtle(v)
+
+
+def _parse_turtle(v) -> Graph:
+    from rdflib import Graph
+    if not PARSE_CACHE:
+        return Graph().parse(source=str(v), format="turtle")
+    cached = get_parse_cache_path(v)
+    try:
+        with open(cached, "rb") as cf:
+            return _load_graph(cf.read())
+    except (OSError, ValueError, EOFError, TypeError, AssertionError):
+        pass
+    class RecordingGraph(Graph):
+        """ keeps the order in which the parser adds triples, which Graph iteration does not preserve """
+        def add(self, triple):
+            ordered.append(triple)
+            return super().add(triple)
+
+    ordered = []
+    g = RecordingGraph().parse(source=str(v), format="turtle")
+    cached.parent.mkdir(parents=True, exist_ok=True)
+    # concurrent workers may cache the same file - write whole then rename
+    data = _dump_graph(g, ordered)
+    # unique to the process and thread - upload threads parse files too
+    tmp = cached.with_suffix(".{}.{}.tmp".format(os.getpid(), threading.get_ident()))
+    with open(tmp, "wb") as cf:
+        cf.write(data)
+    os.replace(tmp, cached)
+    # return what later runs will load, so results do not depend on whether the cache was warm
+    return _load_graph(data)
 
 
 def get_entailedpath(f, g:Graph , fmt, rootpattern='/def/'):
@@ -258,62 +680,1047 @@ def get_entailedpath(f, g:Graph , fmt, rootpattern='/def/'):
 
 FMTS = { 'ttl':'ttl' , 'rdf':'xml', 'jsonld':'json-ld'  }
 
-def make_rdf(f,g=None,rootpath='/def/'):
-    loadable_ttl = None
+# prefixes of the shared JSON-LD context .jsonld outputs are compacted against - those bound by init_graph() in
+# ingest_json.py
+JSONLD_PREFIXES = {
+    'dc': 'http://purl.org/dc/elements/1.1/',
+    'xsd': 'http://www.w3.org/2001/XMLSchema#',
+    'dct': 'http://purl.org/dc/terms/',
+    'skos': 'http://www.w3.org/2004/02/skos/core#',
+    'owl': 'http://www.w3.org/2002/07/owl#',
+    'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+    'rdfs': 'http://www.w3.org/2000/01/rdf-schema#',
+    'dcat': 'http://www.w3.org/ns/dcat#',
+    'iso': 'http://iso.org/tc211/',
+    'spec': 'http://www.opengis.net/def/ont/modspec/',
+    'specrel': 'http://www.opengis.net/def/ont/specrel/',
+    'na': 'http://www.opengis.net/def/metamodel/ogc-na/',
+    'prov': 'http://www.w3.org/ns/prov#',
+}
+
+# the shared context document, written by each run, and the URL it is published at - which outputs refer to
+JSONLD_CONTEXT_PATH = 'definitions/context.jsonld'
+JSONLD_CONTEXT_URL = 'http://defs-dev.opengis.net/ogc-na/' + JSONLD_CONTEXT_PATH
+
+_JSONLD_CONTEXT = None
+
+# number of outputs and validation reports written, and left as they were because their content had not changed
+OUTPUTS = {'written': 0, 'unchanged': 0}
+
+
+def write_if_changed(path, data) -> bool:
+    """ replace a file with new content - atomically, and only if the content differs, so unchanged outputs are not
+    rewritten ( or seen as changed by git )
+    @param data: bytes, or a function writing the content to a binary stream - which is written to a temporary file
+    and compared with the existing one, rather than held in memory
+    @return: True if the file was written
+    """
+    tmp = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    if callable(data):
+        with open(tmp, "wb") as tf:
+            data(tf)
+        if os.path.exists(path) and filecmp.cmp(tmp, path, shallow=False):
+            os.remove(tmp)
+            OUTPUTS['unchanged'] += 1
+            return False
+    else:
+        try:
+            with open(path, "rb") as ef:
+                if ef.read() == data:
+                    OUTPUTS['unchanged'] += 1
+                    return False
+        except FileNotFoundError:
+            pass
+        with open(tmp, "wb") as tf:
+            tf.write(data)
+    os.replace(tmp, path)
+    OUTPUTS['written'] += 1
+    return True
+
+
+def get_jsonld_context():
+    """ the shared JSON-LD context - compiled once per run """
+    global _JSONLD_CONTEXT
+    if _JSONLD_CONTEXT is None:
+        from rdflib.plugins.shared.jsonld.context import Context
+        _JSONLD_CONTEXT = Context(JSONLD_PREFIXES)
+    return _JSONLD_CONTEXT
+
+
+def write_jsonld_context(path=JSONLD_CONTEXT_PATH) -> bool:
+    """ write the shared context document .jsonld outputs refer to by JSONLD_CONTEXT_URL
+    @return: True if the file was written
+    """
+    return write_if_changed(path, json.dumps({'@context': JSONLD_PREFIXES}, indent=2).encode("utf-8"))
+
+
+def serialize_jsonld(g) -> bytes:
+    """ g as JSON-LD compacted against the shared context, which is referred to by URL rather than included. Nodes
+    are listed by id, and blank nodes named by their content, so the same graph is written the same way each time """
+    from rdflib import BNode, Graph
+    from rdflib.plugins.serializers.jsonld import from_rdf
+    from turtle_writer import get_bnode_keys
+    keys = get_bnode_keys(g)
+    if keys:
+        names = {}
+        used = set()
+        for b in sorted(keys, key=keys.get):
+            name = "b" + keys[b][:16]
+            while name in used:
+                name += "_"
+            used.add(name)
+            names[b] = BNode(name)
+        named = Graph()
+        named.addN((*t, named) for t in sorted(tuple(names.get(term, term) for term in t) for t in g))
+        g = named
+    doc = from_rdf(g, get_jsonld_context())
+    if '@graph' in doc:
+        doc['@graph'].sort(key=lambda node: node.get('@id', ''))
+    doc['@context'] = JSONLD_CONTEXT_URL
+    return json.dumps(doc, indent=2, sort_keys=True, ensure_ascii=False).encode("utf-8")
+
+
+def can_fork() -> bool:
+    """ whether this process may fork workers - it must have no other threads running ( e.g. uploads or watchdog's
+    observer ), as a lock one of them held would never be released in the child """
+    return 'fork' in multiprocessing.get_all_start_methods() and threading.active_count() == 1
+
+
+# graphs with at least this many triples have their formats serialised in parallel forked processes - smaller ones
+# are quicker to serialise than to fork for
+SERIALIZE_MIN_TRIPLES = 20000
+# ( graph, graph with triples added in sorted order ) being serialised - inherited by forked serialisers
+_SERIALIZE_JOB = None
+
+
+def serialize_format(fmt, path) -> bool:
+    """ write the graph of _SERIALIZE_JOB in one format, if it has changed
+    @return: True if the file was written
+    """
+    from rdfxml_writer import write_rdfxml
+    from turtle_writer import write_turtle
+    g, ordered = _SERIALIZE_JOB
+    with stage('serialize', format=fmt) as span:
+        if fmt == 'ttl':
+            data = partial(write_turtle, g)
+        elif fmt == 'rdf':
+            data = partial(write_rdfxml, g)
+        elif fmt == 'jsonld':
+            data = serialize_jsonld(ordered)
+        else:
+            data = ordered.serialize(format=FMTS[fmt], encoding="utf-8")
+        span['written'] = write_if_changed(path, data)
+    return span['written']
+
+
+def _serialize_task(fmt, path) -> tuple:
+    """ @return: ( stage timings recorded, OUTPUTS counts ) of serialize_format() in a forked process """
+    mark = len(STAGE_TIMINGS) if STAGE_TIMINGS is not None else 0
+    outputs = dict(OUTPUTS)
+    serialize_format(fmt, path)
+    return STAGE_TIMINGS[mark:] if STAGE_TIMINGS is not None else [], {k: OUTPUTS[k] - outputs[k] for k in OUTPUTS}
+
+
+def make_rdf(f,g=None,rootpath='/def/',formats=None):
+    """ write the entailed graph of a file in each format, under the path of its concept scheme
+    @param formats: FMTS keys to write - default all. Turtle is always written, as it is what is uploaded
+    @return: path of the turtle output, or None if there is none
+    """
+    global _SERIALIZE_JOB
+    from rdflib import Graph
     if not g:
         g = Graph().parse(str(f), format="ttl")
-    #g.serialize(destination=f.replace(".ttl",".rdf"), format="xml")
-    for fmt in FMTS.keys() :
-        newpath, filename, canonical_filename, conceptschemeuri = get_entailedpath(f, g, fmt, rootpattern=rootpath)
-        if newpath:
-            try:
-                Path(Path(newpath).parent).mkdir(parents=True, exist_ok=True)
-            except FileExistsError:
-                pass
-            g.serialize(destination=newpath, format=FMTS[fmt])
-            if fmt == 'ttl':
-                loadable_ttl = newpath
-
+    formats = [fmt for fmt in FMTS if fmt == 'ttl' or formats is None or fmt in formats]
+    ttlpath, filename, canonical_filename, conceptschemeuri = get_entailedpath(f, g, 'ttl', rootpattern=rootpath)
     if filename != canonical_filename:
         print("New file name {} -> {} for {}".format(filename, canonical_filename, conceptschemeuri))
-    return loadable_ttl
+    if not ttlpath:
+        return None
+    try:
+        Path(ttlpath).parent.mkdir(parents=True, exist_ok=True)
+    except FileExistsError:
+        pass
+    paths = {fmt: ttlpath[:-len('ttl')] + fmt for fmt in formats}
+
+    ordered = None
+    if set(formats) - {'ttl', 'rdf'}:
+        # turtle and RDF/XML are written in a stable order by write_turtle() and write_rdfxml(), but other serialisers
+        # write triples in the order they were added to the graph - which would differ from run to run
+        ordered = Graph()
+        ordered.namespace_manager = g.namespace_manager
+        ordered.addN((*t, ordered) for t in sorted(g))
+    _SERIALIZE_JOB = (g, ordered)
+    try:
+        if len(formats) > 1 and len(g) >= SERIALIZE_MIN_TRIPLES and (os.cpu_count() or 1) > 1 and can_fork():
+            # each format in its own process, sharing the graphs copy-on-write
+            with ProcessPoolExecutor(max_workers=len(formats), mp_context=multiprocessing.get_context('fork')) as pool:
+                for timings, outputs in pool.map(_serialize_task, formats, [paths[fmt] for fmt in formats]):
+                    if STAGE_TIMINGS is not None:
+                        STAGE_TIMINGS.extend(timings)
+                    for k in OUTPUTS:
+                        OUTPUTS[k] += outputs[k]
+        else:
+            for fmt in formats:
+                serialize_format(fmt, paths[fmt])
+    finally:
+        _SERIALIZE_JOB = None
+    return ttlpath
 
 
 def log(param):
    print ( param)
 
 
+# per-stage timings - a list of { stage, args, start, seconds, cpu, pid, tid } while being recorded,
+# see scripts/benchmark.py and write_trace()
+STAGE_TIMINGS = None
+
+
+@contextmanager
+def stage(name, **args):
+    """ time a stage of the pipeline, if timings are being recorded
+    @param name: stage name - domain, file, parse, closure, entail, rule, merge, validate, report, serialize,
+    upload, http, initialise
+    @param args: details identifying what the stage worked on - yielded, so details known later can be added
+    """
+    if STAGE_TIMINGS is None:
+        yield args
+        return
+    start = time.perf_counter()
+    cpustart = time.thread_time()
+    try:
+        yield args
+    finally:
+        STAGE_TIMINGS.append({'stage': name, 'args': args, 'start': start, 'seconds': time.perf_counter() - start,
+                              'cpu': time.thread_time() - cpustart, 'pid': os.getpid(), 'tid': threading.get_ident()})
+
+
+def write_trace(path, timings: list):
+    """ write stage timings as Chrome trace events - see chrome://tracing or https://ui.perfetto.dev
+    @param timings: STAGE_TIMINGS records - from this and worker processes
+    """
+    events = []
+    mainpid = os.getpid()
+    for pid in dict.fromkeys(t['pid'] for t in timings):
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0,
+                       'args': {'name': 'update_vocabs' if pid == mainpid else 'worker {}'.format(pid)}})
+    origin = min((t['start'] for t in timings), default=0)
+    for t in timings:
+        args = {k: str(v) for k, v in t['args'].items()}
+        # wall clock time not spent on this thread's CPU is mostly I/O - or waiting on other threads
+        args['cpu_ms'] = round(t['cpu'] * 1000, 3)
+        events.append({'name': t['stage'], 'cat': t['stage'], 'ph': 'X', 'pid': t['pid'], 'tid': t['tid'],
+                       'ts': round((t['start'] - origin) * 1e6, 1), 'dur': round(t['seconds'] * 1e6, 1),
+                       'args': args})
+    with open(path, "w") as tf:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, tf)
+
+
+def rule_profile(timings: list) -> list:
+    """ totals for each SHACL rule applied by the compiled and native engines, slowest first
+    @param timings: STAGE_TIMINGS records
+    @return: list of { rules, rule, label, applications, runs, focus, added, seconds } - runs counts query executions,
+    focus the focus nodes they were run for
+    """
+    rules = {}
+    for t in timings:
+        if t['stage'] != 'rule':
+            continue
+        key = (t['args']['rules'], t['args']['rule'])
+        if key not in rules:
+            rules[key] = {'rules': key[0], 'rule': key[1], 'label': t['args']['label'],
+                          'applications': 0, 'runs': 0, 'focus': 0, 'added': 0, 'seconds': 0.0}
+        rules[key]['applications'] += 1
+        rules[key]['seconds'] += t['seconds']
+        for k in ('runs', 'focus', 'added'):
+            rules[key][k] += t['args'][k]
+    return sorted(rules.values(), key=lambda r: -r['seconds'])
+
+
+def enclosing(timing: dict, timings: list, name):
+    """ the innermost stage called name that a stage ran within - on the same thread - or None """
+    found = None
+    for t in timings:
+        if t['stage'] == name and t['pid'] == timing['pid'] and t['tid'] == timing['tid'] \
+                and t['start'] <= timing['start'] and timing['start'] + timing['seconds'] <= t['start'] + t['seconds'] \
+                and (found is None or t['start'] >= found['start']):
+            found = t
+    return found
+
+
+def print_rule_profile(timings: list, slow: float):
+    """ print rule totals, and each application of a rule taking longer than slow seconds, with the file or closure
+    it was applied to """
+    print("{:>9} {:>7} {:>5} {:>7} {:>7}  rule".format("seconds", "applied", "runs", "focus", "added"))
+    for r in rule_profile(timings):
+        print("{:9.3f} {:7} {:5} {:7} {:7}  {}{} ( {} )".format(
+            r['seconds'], r['applications'], r['runs'], r['focus'], r['added'], r['rule'],
+            " \"{}\"".format(r['label']) if r['label'] else "", r['rules']))
+    for t in timings:
+        if t['stage'] == 'rule' and t['seconds'] > slow:
+            within = enclosing(t, timings, 'file') or enclosing(t, timings, 'closure')
+            print("Slow rule {} {:.3f}s for {} focus nodes adding {} triples - {}".format(
+                t['args']['rule'], t['seconds'], t['args']['focus'], t['args']['added'],
+                within['args'].get('file') or within['args'].get('closure') if within else "unknown file"))
+
+
+# rule engines - see Entailer
+ENGINES = ('compiled', 'native', 'pyshacl')
+ENGINE = 'compiled'
+# repeat each shape's rules until they add nothing new - as pyshacl iterate_rules
+ITERATE_RULES = False
+RULES_ITERATE_LIMIT = 100
+# placeholder for the focus nodes of batched queries - see Entailer._batch_query()
+_THIS_PLACEHOLDER = 'urn:x-ogcna:this'
+
+
+class Entailer:
+    """ Applies an ordered list of SHACL rule graphs to any number of data graphs.
+
+    Each rule graph is parsed once, and its sh:SPARQLRule CONSTRUCT queries are compiled once. Engines:
+    compiled - run each query per focus node with $this pre-bound - the same semantics as pyshacl advanced mode
+    native - run each query once per rule for all focus nodes, bound through an injected VALUES clause, and when
+    iterating to a fixpoint re-run rules only for focus nodes touched by newly derived triples ( semi-naive ),
+    confirming the fixpoint with a final pass over all focus nodes
+    pyshacl - hand each rule graph to pyshacl
+
+    Rule graphs using features not handled here ( sh:condition, sh:TripleRule, custom targets ... ) are always run
+    through pyshacl.
+    """
+
+    def __init__(self, rulegraphlist: List[str], engine: str = None, iterate: bool = None):
+        self.rulegraphlist = list(rulegraphlist)
+        self.engine = engine or ENGINE
+        self.iterate = ITERATE_RULES if iterate is None else iterate
+        assert self.engine in ENGINES, "Unknown rule engine {}".format(self.engine)
+        self.stages = []
+        for rules in self.rulegraphlist:
+            shg = parse_turtle(rules)
+            try:
+                compiled = None if self.engine == 'pyshacl' else self._compile_rules(shg, self.engine == 'native')
+                self.stages.append((rules, shg, compiled))
+            except Exception as e:
+                raise Exception("SHACL error in {}: {}".format(rules, str(e)))
+
+    @classmethod
+    def _compile_rules(cls, shg: Graph, batch=False):
+        """ ordered list of ( shape, rule, compiled construct queries ) for a rules graph - None if the graph
+        needs pyshacl """
+        from rdflib import Literal, URIRef
+        from rdflib.namespace import RDF, SH
+        from rdflib.plugins.sparql import prepareQuery
+        for unsupported in (SH.TripleRule, SH.JSRule):
+            if (None, RDF.type, unsupported) in shg:
+                return None
+        # grouped by shape in graph order, then stable sorted by sh:order - as pyshacl does
+        shapes = {}
+        for shape, rule in shg.subject_objects(SH.rule):
+            if (rule, RDF.type, SH.SPARQLRule) not in shg or (rule, SH.condition, None) in shg \
+                    or (shape, SH.target, None) in shg:
+                return None
+            if shg.value(rule, SH.deactivated) == Literal(True) or shg.value(shape, SH.deactivated) == Literal(True):
+                continue
+            initns = {}
+            for prefixes in shg.objects(rule, SH.prefixes):
+                for decl in shg.objects(prefixes, SH.declare):
+                    initns[str(shg.value(decl, SH.prefix))] = URIRef(str(shg.value(decl, SH.namespace)))
+            queries = []
+            for construct in shg.objects(rule, SH.construct):
+                binds_this = bool(re.search(r"[?$]this\b", str(construct)))
+                batched = cls._batch_query(str(construct), initns) if batch and binds_this else None
+                queries.append((None if batched else prepareQuery(str(construct), initNs=initns),
+                                binds_this, batched))
+            shapes.setdefault(shape, []).append(((shg.value(rule, SH.order) or Literal(0)).toPython(), rule, queries))
+        compiled = []
+        for shape in sorted(shapes, key=lambda sh: (shg.value(sh, SH.order) or Literal(0)).toPython()):
+            for _, rule, queries in sorted(shapes[shape], key=lambda r: r[0]):
+                compiled.append((shape, rule, queries))
+        return compiled
+
+    @staticmethod
+    def _batch_query(construct: str, initns: dict):
+        """ compile a CONSTRUCT with "VALUES ?this { ... }" at the start of its WHERE clause
+        @return: ( prepared query, its VALUES algebra node ) or None if the query cannot be batched this way
+        """
+        from rdflib import Variable
+        from rdflib.plugins.sparql import prepareQuery
+        if re.search(r"\bCONSTRUCT\s+WHERE\b", construct, re.I) or re.search(r"\bSELECT\b", construct, re.I):
+            # short form, or sub-selects which do not see the bindings of the enclosing query
+            return None
+        where = re.search(r"\bWHERE\s*\{", construct, re.I)
+        if not where:
+            return None
+        query = prepareQuery("{} VALUES ?this {{ <{}> }} {}".format(
+            construct[:where.end()], _THIS_PLACEHOLDER, construct[where.end():]).replace("$this", "?this"),
+            initNs=initns)
+        found = []
+
+        def find_values(node, parent=None):
+            if getattr(node, 'name', None) == 'values' and \
+                    [{str(k): str(v) for k, v in row.items()} for row in node.res] == [{'this': _THIS_PLACEHOLDER}]:
+                found.append((node, parent))
+            elif isinstance(node, dict):
+                for child in node.values():
+                    find_values(child, node)
+            elif isinstance(node, (list, tuple)):
+                for child in node:
+                    find_values(child, node)
+
+        find_values(query.algebra)
+        if len(found) != 1 or getattr(found[0][1], 'name', None) != 'ToMultiSet':
+            return None
+        values, tomultiset = found[0]
+        # rdflib does not record the variables bound by VALUES, so an OPTIONAL following it would be re-checked
+        # as if ?this were unbound
+        values._vars = tomultiset._vars = {Variable('this')}
+        return query, values
+
+    @staticmethod
+    def focus_nodes(shg: Graph, shape, g: Graph):
+        """ SHACL target nodes of a shape in a data graph """
+        from rdflib.namespace import OWL, RDF, RDFS, SH
+        nodes = set(shg.objects(shape, SH.targetNode))
+        classes = set(shg.objects(shape, SH.targetClass))
+        if (shape, RDF.type, RDFS.Class) in shg or (shape, RDF.type, OWL.Class) in shg:
+            classes.add(shape)
+        for c in classes:
+            for subclass in g.transitive_subjects(RDFS.subClassOf, c):
+                nodes.update(g.subjects(RDF.type, subclass))
+        for p in shg.objects(shape, SH.targetSubjectsOf):
+            nodes.update(g.subjects(p, None))
+        for p in shg.objects(shape, SH.targetObjectsOf):
+            nodes.update(g.objects(None, p))
+        return nodes
+
+    def _construct(self, queries, nodes, g: Graph) -> list:
+        """ graphs constructed by a rule's queries for a set of focus nodes """
+        from rdflib import Variable
+        constructed = []
+        if not nodes:
+            return constructed
+        for query, binds_this, batch in queries:
+            if batch:
+                batchquery, values = batch
+                values.res = [{Variable('this'): node} for node in nodes]
+                try:
+                    constructed.append(g.query(batchquery).graph)
+                finally:
+                    values.res = []
+            elif not binds_this and self.engine == 'native':
+                # the same result for every focus node
+                constructed.append(g.query(query).graph)
+            else:
+                for node in nodes:
+                    constructed.append(g.query(query, initBindings={'this': node} if binds_this else None).graph)
+        return constructed
+
+    def _apply_rule(self, shg: Graph, shape, rule, queries, g: Graph, rules=None, target: Graph = None) -> int:
+        """ apply a rule - to a fixpoint if iterating
+        @param rules: the rules file, for stage timings
+        @param target: graph to add derived triples to, if not g - g must include it
+        @return: number of triples added
+        """
+        from rdflib.namespace import RDFS
+        with stage('rule', rules=rules, rule=str(rule), label=shg.value(rule, RDFS.label), runs=0, focus=0, added=0) as span:
+            total = 0
+            nodes = self.focus_nodes(shg, shape, g)
+            for _ in range(RULES_ITERATE_LIMIT):
+                added = []
+                constructed = self._construct(queries, nodes, g)
+                span['runs'] += len(constructed)
+                span['focus'] += len(nodes)
+                # add only after all focus nodes are done, so results do not depend on focus node order
+                for cg in constructed:
+                    for t in cg:
+                        if t not in g:
+                            (g if target is None else target).add(t)
+                            added.append(t)
+                total += len(added)
+                span['added'] = total
+                if not self.iterate:
+                    return total
+                allnodes = self.focus_nodes(shg, shape, g)
+                if self.engine != 'native':
+                    nodes = allnodes
+                elif added:
+                    # semi-naive - only focus nodes the new triples are about
+                    touched = set(t[0] for t in added) | set(t[2] for t in added)
+                    nodes = allnodes & touched
+                    continue
+                elif nodes != allnodes:
+                    # confirm the fixpoint over every focus node
+                    nodes = allnodes
+                    continue
+                if not added:
+                    return total
+            raise Exception("SHACL rule iteration exceeded iteration limit of {}".format(RULES_ITERATE_LIMIT))
+
+    def entail(self, g: Graph, extra: Graph = None) -> Graph:
+        """ apply the rules in place - like pyshacl inplace mode, any closure graph is mixed into g
+        @param g: data graph
+        @param extra: closure graph
+        @return: g
+        """
+        if extra:
+            g += extra
+        for rules, shg, compiled in self.stages:
+            try:
+                with stage('entail', rules=rules):
+                    self._apply_rules(shg, compiled, g, rules)
+            except Exception as e:
+                raise Exception("SHACL error in {}: {}".format(rules, str(e)))
+        return g
+
+    def derive(self, g: Graph, extra: Graph = None) -> Graph:
+        """ the triples the rules derive from a data graph and a closure graph, without modifying or copying either -
+        the rules see a read-only union of the data, closure and derived triples
+        @param g: data graph
+        @param extra: closure graph
+        @return: graph of derived triples, none of which are in g or extra
+        """
+        from rdflib import Graph
+        from rdflib.graph import ReadOnlyGraphAggregate
+        derived = Graph()
+        union = ReadOnlyGraphAggregate([g] + ([extra] if extra is not None else []) + [derived])
+        for rules, shg, compiled in self.stages:
+            try:
+                with stage('entail', rules=rules):
+                    self._apply_rules(shg, compiled, union, rules, target=derived)
+            except Exception as e:
+                raise Exception("SHACL error in {}: {}".format(rules, str(e)))
+        return derived
+
+    def _apply_rules(self, shg: Graph, compiled, g: Graph, rules=None, target: Graph = None):
+        """ apply the rules of one rules graph to g, shape by shape
+        @param target: graph to add derived triples to, if not g - g must include it
+        """
+        if compiled is None:
+            from pyshacl import validate
+            if target is None:
+                validate(g, shacl_graph=shg, ont_graph=None, advanced=True, inplace=True, iterate_rules=self.iterate)
+                return
+            from rdflib import Graph
+            merged = Graph()
+            merged += g
+            validate(merged, shacl_graph=shg, ont_graph=None, advanced=True, inplace=True, iterate_rules=self.iterate)
+            for t in merged:
+                if t not in g:
+                    target.add(t)
+            return
+        i = 0
+        while i < len(compiled):
+            shape = compiled[i][0]
+            shaperules = [(rule, queries) for s, rule, queries in compiled[i:] if s == shape]
+            i += len(shaperules)
+            for _ in range(RULES_ITERATE_LIMIT):
+                if not sum(self._apply_rule(shg, shape, rule, queries, g, rules, target) for rule, queries in shaperules) \
+                        or not self.iterate:
+                    break
+            else:
+                raise Exception("SHACL rule iteration exceeded iteration limit of {}".format(RULES_ITERATE_LIMIT))
+
+
+class Validator:
+    """ Validates any number of data graphs against a validator shapes graph, parsed and compiled once """
+
+    def __init__(self, vlist: List[str]):
+        self.sources = list(vlist)
+        self.graph = get_closure_graph(vlist)
+        self._shapes = None
+
+    def validate(self, data_graph: Graph, ont_graph: Graph = None, inference='rdfs'):
+        """ validate a data graph - without modifying it
+        @return: ( conforms, results graph, results text ) as for pyshacl.validate()
+        """
+        try:
+            from pyshacl.validator import Validator as ShaclValidator
+            from pyshacl.shapes_graph import ShapesGraph
+            from pyshacl.monkey import apply_patches
+            try:
+                from pyshacl.graph_abstraction import DataGraph
+                data = DataGraph.from_rdflib(data_graph)
+            except ImportError:
+                data = data_graph
+            if self._shapes is None:
+                apply_patches()
+                self._shapes = ShapesGraph(self.graph)
+            v = ShaclValidator(data, shacl_graph=self.graph, ont_graph=ont_graph,
+                               options={'inference': inference, 'logger': logging.getLogger(__name__)})
+        except (ImportError, TypeError):
+            # pyshacl internals differ - let it rebuild the shapes each time
+            from pyshacl import validate
+            return validate(data_graph=data_graph, ont_graph=ont_graph, inference=inference, shacl_graph=self.graph)
+        v.shacl_graph = self._shapes
+        return v.run()
+
+
+_ENTAILER_CACHE = {}
+_VALIDATOR_CACHE = {}
+
+
+def get_entailer(rulegraphlist: List[str]) -> Entailer:
+    """ Entailer for a rule list, created once per run """
+    if tuple(rulegraphlist) not in _ENTAILER_CACHE:
+        _ENTAILER_CACHE[tuple(rulegraphlist)] = Entailer(rulegraphlist)
+    return _ENTAILER_CACHE[tuple(rulegraphlist)]
+
+
+def get_validator(vlist: List[str]) -> Validator:
+    """ Validator for a list of shapes files, created once per run """
+    if tuple(vlist) not in _VALIDATOR_CACHE:
+        _VALIDATOR_CACHE[tuple(vlist)] = Validator(vlist)
+    return _VALIDATOR_CACHE[tuple(vlist)]
+
+
+_CLOSURE_CACHE = {}
+
+
+def get_entailed_closure(vlist: List[str], rulegraphlist: List[str]):
+    """ get the closure graph for a domain with the domain entailment rules applied.
+    Computed once per run for each ( closure, rules ) combination and shared by every file and domain using it -
+    callers must treat the result as read-only.
+    @param vlist: closure ontology files or URLs
+    @param rulegraphlist: ordered list of entailment rules to apply in provided order
+    @return: entailed closure graph
+    """
+    key = (tuple(vlist), tuple(rulegraphlist))
+    if key not in _CLOSURE_CACHE:
+        if tuple(vlist) not in _CLOSURE_CACHE:
+            _CLOSURE_CACHE[tuple(vlist)] = get_closure_graph(vlist)
+        from rdflib import Graph
+        entailed_extra = Graph()
+        entailed_extra += _CLOSURE_CACHE[tuple(vlist)]
+        try:
+            with stage('closure', closure=list(vlist)):
+                get_entailer(rulegraphlist).entail(entailed_extra)
+        except Exception as e:
+            raise Exception("SHACL error entailing baseline for closure : {}".format(str(e)))
+        _CLOSURE_CACHE[key] = entailed_extra
+    return _CLOSURE_CACHE[key]
+
+
 def perform_entailments(rulegraphlist, f, g=None, extra=None, anno=[]):
     """ run skos graph entailments
     @param anno:
     @param rulegraphlist: ordered list of entailment rules to apply in provided order
     @param f:
     @param g:
-    @param extra:
+    @param extra: closure graph already entailed with rulegraphlist - see get_entailed_closure()
     @param annotations:
     @return:
     """
-    entailed_extra = extra
     if not g:
-        g = Graph().parse(str(f), format="ttl")
-    for rules in rulegraphlist:
-        shg = Graph().parse(rules, format="ttl")
-        if extra:
-            entailed_extra = extra
+        g = parse_turtle(f)
+    # the closure is kept apart rather than mixed in and subtracted again, which would also drop any source triples
+    # that happen to be in the closure
+    derived = get_entailer(rulegraphlist).derive(g, extra)
+    with stage('merge'):
+        g += derived
+    return g
+
+
+def process_file(f, cfg, extra_ont=None):
+    """ entail, validate and serialise a single domain file
+    @param f: source file
+    @param cfg: DOMAIN_CFG entry the file belongs to
+    @param extra_ont: closure graph for the domain, if any
+    @return: ( path of the loadable entailed turtle, graph name )
+    """
+    newg = perform_entailments(cfg['rulelist'],f,extra=extra_ont, anno=cfg.get('annotations', []))
+    with stage('validate'):
+        v = get_validator(cfg['validator']).validate(newg, ont_graph=extra_ont, inference='rdfs')
+    if True or not v[0]:
+        with stage('report') as span:
+            span['written'] = write_if_changed(str(f).replace('.ttl','.txt'), v[2].encode("utf-8"))
+    loadable_path = make_rdf(f, g=newg, rootpath=cfg['uri_root_filter'], formats=cfg.get('formats'))
+    try:
+        gname = list(get_graph_uri_for_vocab(None, newg))[0]
+    except:
+        gname = "x-urn:{}".format(str(f).replace('\\', ':'))
+    return loadable_path, gname
+
+
+def get_uploads(f, loadable_path, gname):
+    """ ( source file, file to load, graph name ) for an entailed file - the domain annotations are uploaded once,
+    to graphs of their own, see upload_annotation() """
+    return [(f, loadable_path, gname)]
+
+
+# send only changed triples rather than replacing whole graphs - see load_vocab_delta()
+DELTA_UPLOAD = False
+
+
+def _upload(upload):
+    f, loadable, gname = upload
+    try:
+        with stage('upload', file=loadable, graph=gname):
+            if DELTA_UPLOAD:
+                loc, delta = load_vocab_delta( loadable, gname)
+                if delta is None:
+                    return "Uploaded {} for {} to   {} ( blank nodes changed )".format(loadable, f, loc)
+                return "Updated {} for {} in   {} ( -{} +{} triples )".format(loadable, f, loc, *delta)
+            loc = load_vocab( loadable, gname)
+            return "Uploaded {} for {} to   {} ".format(loadable, f, loc)
+    except  Exception as e:
+        return "Failed to upload {} for {} : ( {} )".format(loadable, f, e)
+
+
+def get_recorded_graphs() -> set:
+    """ the graphs recorded in the manifests of every domain """
+    return set(g for scopepath in DOMAIN_CFG for entry in load_manifest(scopepath).values()
+               for g in entry.get('graphs', []))
+
+
+def get_entailed_files(domain=None):
+    """ ( cfg, entailed turtle file, graph names ) for the entailed output of every file of every domain - or of one
+    domain - as recorded in the domain manifests, so stray copies under entailed/ are never loaded """
+    manifests = {}
+    missing = {}
+    for scopepath, cfg, f in get_domain_files(domain):
+        if scopepath not in manifests:
+            manifests[scopepath] = load_manifest(scopepath)
+        entry = manifests[scopepath].get(Path(f).as_posix())
+        if not entry or not entry.get('output') or not os.path.exists(entry['output']):
+            missing[scopepath] = missing.get(scopepath, 0) + 1
+            continue
+        yield cfg, entry['output'], entry.get('graphs', [])
+    for scopepath, n in missing.items():
+        log("Warning - {} files of {} have no entailed output recorded in {} - not loaded".format(
+            n, scopepath, get_manifest_path(scopepath)))
+
+
+def write_nquads(out, g: Graph, gname):
+    """ write the triples of g to a binary stream as N-Quads in named graph gname """
+    context = " <{}> .\n".format(gname).encode("utf-8")
+    for line in g.serialize(format="nt", encoding="utf-8").splitlines():
+        line = line.rstrip()
+        if line:
+            # N-Triples lines end with " ."
+            out.write(line[:-1].rstrip() + context)
+
+
+def initialise(domain=None, compress=False):
+    """ replace the whole content of the triplestore repository with every entailed output, and the annotations
+    of their domains - once each, in their shared graphs - in one transaction, streamed from a single N-Quads file
+    @param domain: load one domain only - replacing only its graphs, and dropping the numbered annotation graphs of
+    its files left by earlier versions of this script ( see get_legacy_annotation_graphs() ), and leaving those of
+    other domains
+    @param compress: gzip the N-Quads - the server must accept gzip Content-Encoding
+    @return: ( number of graphs, number of quads )
+    """
+    import httpx
+    payload = Path(CACHE_DIR) / ("initialise.nq.gz" if compress else "initialise.nq")
+    payload.parent.mkdir(parents=True, exist_ok=True)
+    graphs = []
+    legacy = []
+    quads = 0
+    annotations = []
+    with stage('initialise', domain=domain), (gzip.open if compress else open)(payload, "wb") as out:
+        for cfg, loadable, contexts in get_entailed_files(domain):
             try:
-                validate(entailed_extra, shacl_graph=shg, ont_graph=None,  advanced=True, inplace=True)
+                g = parse_turtle(loadable)
             except Exception as e:
-                raise Exception("SHACL error entailing baseline for closure in {} : {}".format(rules,str(e)))
+                log("Failed to load {} : ( {}  )".format(loadable, e))
+                continue
+            for context in contexts:
+                write_nquads(out, g, context)
+                graphs.append(context)
+                quads += len(g)
+            annotations += [a for a in cfg.get('annotations', []) if a not in annotations]
+            legacy += [g for context in contexts
+                       for g in get_legacy_annotation_graphs(context, cfg.get('annotations', []))]
+        for annotation in annotations:
+            try:
+                ag = parse_turtle(annotation)
+            except Exception as e:
+                log("Failed to load {} : ( {}  )".format(annotation, e))
+                continue
+            guri = get_annotation_graph(annotation)
+            write_nquads(out, ag, guri)
+            out.write('<{0}> <{1}> "{2}" <{0}> .\n'.format(guri, CONTENT_HASH, get_file_hash(annotation)).encode("utf-8"))
+            graphs.append(guri)
+            quads += len(ag) + 1
+    if domain:
+        recorded = get_recorded_graphs()
+        clear = " ;\n".join("DROP SILENT GRAPH <{}>".format(g)
+                            for g in dict.fromkeys(graphs + [g for g in legacy if g not in recorded])) or None
+    else:
+        clear = "CLEAR ALL"
+    repository = "{}/rdf4j-server/repositories/{}".format(RDF4JSERVER, REPO)
+    headers = {"Content-Type": "application/n-quads;charset=UTF-8"}
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+    txn = rdf4j_request("POST", repository + "/transactions").headers["Location"]
+    try:
+        if clear:
+            rdf4j_request("PUT", txn, params={"action": "UPDATE"}, content=clear.encode("utf-8"),
+                          headers={"Content-Type": "application/sparql-update;charset=UTF-8"})
+        rdf4j_request("PUT", txn, body_path=payload, params={"action": "ADD"}, headers=headers)
+        rdf4j_request("PUT", txn, params={"action": "COMMIT"})
+    except Exception:
         try:
-            validate(g, shacl_graph=shg, ont_graph=extra,  advanced=True, inplace=True )
-        except Exception as e:
-            raise Exception ( "SHACL error in {}: {}".format(rules, str(e)))
-    if entailed_extra:
-        cleaned = g-entailed_extra
-        cleaned.namespace_manager = g.namespace_manager
-        return cleaned
+            get_http_client().delete(txn)
+        except httpx.HTTPError:
+            pass
+        raise
+    # the last uploaded content of each graph replaced - see load_vocab_delta() - is no longer known
+    if domain:
+        for g in graphs:
+            get_upload_cache_path(g).unlink(missing_ok=True)
     else:
-        return g
+        shutil.rmtree(get_upload_cache_path('').parent, ignore_errors=True)
+    return len(set(graphs)), quads
+
+
+# seconds to entail, validate and serialise a byte of turtle - estimates the cost of files never timed, unless the
+# recorded build times give a better rate
+SECONDS_PER_BYTE = 2e-5
+
+
+def get_costs(files, seconds: dict) -> list:
+    """ estimated seconds to process each of a list of files - as long as its last recorded build, or in proportion
+    to file size
+    @param files: list of ( scopepath, file )
+    @param seconds: { scopepath: build times } - see load_build_seconds()
+    """
+    rates = [t / os.path.getsize(f) for times in seconds.values() for f, t in times.items()
+             if t and os.path.exists(f) and os.path.getsize(f)]
+    rate = sorted(rates)[len(rates) // 2] if rates else SECONDS_PER_BYTE
+    return [seconds.get(scopepath, {}).get(Path(f).as_posix()) or (os.path.getsize(f) if os.path.exists(f) else 0) * rate
+            for scopepath, f in files]
+
+
+def parse_shard(spec):
+    """ @param spec: "i/n" - shard i ( from 1 ) of n
+    @return: ( i, n ) """
+    try:
+        index, count = (int(x) for x in spec.split("/"))
+    except ValueError:
+        raise ValueError("shard must be given as i/n, not {}".format(spec))
+    if not 1 <= index <= count:
+        raise ValueError("shard {} is not one of 1 to {}".format(index, count))
+    return index, count
+
+
+def select_shard(work, index, count, seconds: dict):
+    """ the part of the work a shard does - files are dealt to shards most expensive first, each to the shard with
+    the least work so far ( longest processing time first ). Costs come from the committed build times and file
+    sizes only, so every shard of the same commit computes the same partition. Removed files are all handled by
+    shard 1.
+    @param work: list of ( scopepath, cfg, modified, added, removed ) for each domain
+    @param index: shard - from 1
+    @param count: number of shards
+    @param seconds: { scopepath: build times } - see load_build_seconds()
+    @return: work with only the files of this shard
+    """
+    files = [(scopepath, f) for scopepath, _, modified, added, _ in work for f in modified + added]
+    costs = get_costs(files, seconds)
+    loads = [0.0] * count
+    mine = set()
+    for i in sorted(range(len(files)), key=lambda i: (-costs[i], Path(files[i][1]).as_posix())):
+        shard = loads.index(min(loads))
+        loads[shard] += costs[i]
+        if shard == index - 1:
+            mine.add((files[i][0], Path(files[i][1]).as_posix()))
+    log("Shard {} of {} : {} of {} files, estimated {:.1f}s of {:.1f}s".format(
+        index, count, len(mine), len(files), loads[index - 1], sum(loads)))
+    return [(scopepath, cfg, [f for f in modified if (scopepath, Path(f).as_posix()) in mine],
+             [f for f in added if (scopepath, Path(f).as_posix()) in mine], removed if index == 1 else [])
+            for scopepath, cfg, modified, added, removed in work]
+
+
+# ( scopepath, cfg, file, closure graph ) work items - module level so forked workers share them read-only
+_TASKS = []
+
+
+def _run_task(i):
+    """ @return: ( captured output, result, seconds, stage timings recorded for the task, OUTPUTS counts for the task ) """
+    scopepath, cfg, f, extra_ont = _TASKS[i]
+    out = io.StringIO()
+    mark = len(STAGE_TIMINGS) if STAGE_TIMINGS is not None else 0
+    outputs = dict(OUTPUTS)
+    start = time.perf_counter()
+    with redirect_stdout(out):
+        try:
+            with stage('file', file=str(f), domain=scopepath):
+                result = process_file(f, cfg, extra_ont)
+        except Exception as e:
+            log("Failed to generate {} : ( {}  )".format(f, e))
+            result = None
+    return out.getvalue(), result, time.perf_counter() - start, \
+        STAGE_TIMINGS[mark:] if STAGE_TIMINGS is not None else [], {k: OUTPUTS[k] - outputs[k] for k in OUTPUTS}
+
+
+def get_jobs(ntasks, jobs=1) -> int:
+    """ @return: number of worker processes run_tasks() uses - 1 if the tasks are run in this process
+    @param jobs: number of worker processes asked for - 0 for one per CPU
+    """
+    if jobs == 0:
+        jobs = os.cpu_count()
+    if ntasks <= 1 or jobs <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        return 1
+    return jobs
+
+
+def run_tasks(ntasks, jobs=1, order=None):
+    """ run the first ntasks entries of _TASKS, yielding ( captured output, result, seconds ) in task order.
+    Stage timings recorded by worker processes are added to STAGE_TIMINGS, and their output counts to OUTPUTS.
+    All worker processes are forked when the first result is asked for
+    @param ntasks: number of tasks
+    @param jobs: number of worker processes - 0 for one per CPU
+    @param order: task indexes in the order worker processes should start them - default task order
+    """
+    if (jobs or os.cpu_count()) > 1 and ntasks > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+        print('Warning - parallel jobs need fork() support - running sequentially')
+    jobs = get_jobs(ntasks, jobs)
+    if jobs == 1:
+        for i in range(ntasks):
+            yield _run_task(i)[:3]
+        return
+    with ProcessPoolExecutor(max_workers=min(jobs, ntasks), mp_context=multiprocessing.get_context('fork')) as pool:
+        futures = [None] * ntasks
+        for i in order if order is not None else range(ntasks):
+            futures[i] = pool.submit(_run_task, i)
+        for future in futures:
+            output, result, seconds, timings, outputs = future.result()
+            if STAGE_TIMINGS is not None:
+                STAGE_TIMINGS.extend(timings)
+            for k in OUTPUTS:
+                OUTPUTS[k] += outputs[k]
+            yield output, result, seconds
+
+
+# seconds between checks for changed files in watch mode, when watchdog is not installed
+WATCH_INTERVAL = 0.5
+# seconds to wait for more changes after the first, so an editor's save is one rebuild
+WATCH_SETTLE = 0.1
+
+
+def invalidate_caches(changed):
+    """ forget file hashes, rule sets, validators and closures built from any of a set of changed files """
+    changed = set(os.path.normpath(f) for f in changed)
+    for v in list(_HASH_CACHE):
+        if os.path.normpath(v) in changed:
+            del _HASH_CACHE[v]
+    for cache in (_ENTAILER_CACHE, _VALIDATOR_CACHE):
+        for key in list(cache):
+            if changed.intersection(os.path.normpath(v) for v in key):
+                del cache[key]
+    for key in list(_CLOSURE_CACHE):
+        # keyed by closure files, or by ( closure files, rule files )
+        if changed.intersection(os.path.normpath(v) for v in (key[0] + key[1] if isinstance(key[0], tuple) else key)):
+            del _CLOSURE_CACHE[key]
+
+
+def get_watched_files(domain=None) -> dict:
+    """ { file : modification time } for the files of a domain - or of all domains - and everything they depend on """
+    files = set()
+    for _, cfg, f in get_domain_files(domain):
+        files.add(f)
+        files.update(get_domain_inputs(cfg))
+    mtimes = {}
+    for f in files:
+        try:
+            mtimes[f] = os.stat(f).st_mtime_ns
+        except OSError:
+            pass
+    return mtimes
+
+
+def _get_change_waiter(dirs):
+    """ a function waiting until a file may have changed - woken by filesystem events if watchdog is installed,
+    otherwise polling every WATCH_INTERVAL seconds """
+    try:
+        from watchdog.events import FileSystemEventHandler
+        from watchdog.observers import Observer
+    except ImportError:
+        return lambda: time.sleep(WATCH_INTERVAL)
+    event = threading.Event()
+
+    class Handler(FileSystemEventHandler):
+        def on_any_event(self, e):
+            if not e.is_directory:
+                event.set()
+
+    observer = Observer()
+    for d in dirs:
+        observer.schedule(Handler(), d, recursive=False)
+    observer.daemon = True
+    observer.start()
+
+    def wait():
+        event.wait()
+        time.sleep(WATCH_SETTLE)
+        event.clear()
+    return wait
+
+
+def rebuild(changed, domain=None, update=False):
+    """ entail, validate and serialise - and upload if update - the domain files depending on changed files """
+    cfgs = {f: (scopepath, cfg) for scopepath, cfg, f in get_domain_files(domain)}
+    manifests = {}
+    annotated = set()
+    for f in get_dependents(changed):
+        if f not in cfgs:
+            continue
+        scopepath, cfg = cfgs[f]
+        start = time.perf_counter()
+        try:
+            extra_ont = get_entailed_closure(cfg['extraont'], cfg['rulelist']) if cfg.get('extraont') else None
+            loadable_path, gname = process_file(f, cfg, extra_ont)
+        except Exception as e:
+            log("Failed to generate {} : ( {}  )".format(f, e))
+            continue
+        if scopepath not in manifests:
+            manifests[scopepath] = load_manifest(scopepath)
+        seconds = time.perf_counter() - start
+        manifests[scopepath][Path(f).as_posix()] = get_manifest_entry(f, cfg, loadable_path, gname)
+        log("Rebuilt {} in {:.2f}s".format(f, seconds))
+        if update:
+            for u in get_uploads(f, loadable_path, gname):
+                log(_upload(u))
+            for annotation in cfg.get('annotations', []):
+                if annotation not in annotated:
+                    annotated.add(annotation)
+                    log(upload_annotation(annotation))
+    for scopepath, manifest in manifests.items():
+        save_manifest(scopepath, manifest)
+
+
+def watch(domain=None, update=False):
+    """ rebuild the files depending on each changed source, rule, validator or closure file until interrupted -
+    keeping parsed rules, validators and entailed closures in memory between changes
+    @param domain: watch one domain only
+    @param update: upload rebuilt files
+    """
+    mtimes = get_watched_files(domain)
+    log("Loading rules, validators and closures for {} files".format(len(mtimes)))
+    loaded = []
+    for scopepath, cfg, _ in get_domain_files(domain):
+        if any(cfg is c for c in loaded):
+            continue
+        loaded.append(cfg)
+        try:
+            get_entailer(cfg['rulelist'])
+            get_validator(cfg['validator'])
+            if cfg.get('extraont'):
+                get_entailed_closure(cfg['extraont'], cfg['rulelist'])
+        except Exception as e:
+            log("Failed to load {} : ( {}  )".format(scopepath, e))
+    wait = _get_change_waiter(sorted(set(os.path.dirname(os.path.abspath(f)) for f in mtimes)))
+    log("Watching {} files for changes - Ctrl-C to stop".format(len(mtimes)))
+    try:
+        while True:
+            wait()
+            current = get_watched_files(domain)
+            changed = sorted(f for f in set(mtimes) | set(current) if mtimes.get(f) != current.get(f))
+            mtimes = current
+            if changed:
+                log("Changed: " + ",".join(changed))
+                invalidate_caches(changed)
+                rebuild(changed, domain, update)
+    except KeyboardInterrupt:
+        log("Stopped watching")
 
 
 if __name__ == "__main__":
@@ -351,7 +1758,15 @@ if __name__ == "__main__":
     parser.add_argument(
         "-i",
         "--initialise",
-        help="Initialise Database",
+        action='store_true',
+        help="Initialise Database - replace its whole content with every entailed output ( of -d only, if given ) "
+             "and its annotations, in one transaction",
+    )
+
+    parser.add_argument(
+        "--gzip",
+        action='store_true',
+        help="with -i, gzip the N-Quads sent to the database",
     )
 
     parser.add_argument(
@@ -375,6 +1790,34 @@ if __name__ == "__main__":
         help="force overwrite of existing entailments",
     )
 
+    parser.add_argument(
+        "-n",
+        "--incremental",
+        action='store_true',
+        help="Entail all vocabs whose source, rules, validator or closure changed since the last build "
+             "( recorded in entailed/" + MANIFEST_NAME + " )",
+    )
+
+    parser.add_argument(
+        "--dependents",
+        action='store_true',
+        help="also entail every domain file depending on the modified, added or removed files - through its domain "
+             "rules, validator, closure or annotations, or owl:imports",
+    )
+
+    parser.add_argument(
+        "--watch",
+        action='store_true',
+        help="keep running, and rebuild ( and upload with -u ) the files depending on each changed file - "
+             "uses watchdog if installed",
+    )
+
+    parser.add_argument(
+        "--shard",
+        help="i/n - process only shard i ( from 1 ) of n, for splitting a batch across jobs. Files are balanced "
+             "across shards by their time in the last build, or their size",
+    )
+
     parser.add_argument(
         "-s",
         "--server" ,
@@ -387,12 +1830,83 @@ if __name__ == "__main__":
         help="override triplestore repo - default =  " + REPO,
     )
 
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of worker processes for entailment ( 0 = one per CPU )",
+    )
+
+    parser.add_argument(
+        "--delta",
+        action='store_true',
+        help="with -u, send only the triples that changed since the last upload ( cached under {} )".format(CACHE_DIR),
+    )
+
+    parser.add_argument(
+        "--no-parse-cache",
+        action='store_true',
+        help="always parse turtle sources rather than loading them from the parse cache under {}".format(CACHE_DIR),
+    )
+
+    parser.add_argument(
+        "--engine",
+        choices=ENGINES,
+        default=ENGINE,
+        help="SHACL rule engine - default = {}".format(ENGINE),
+    )
+
+    parser.add_argument(
+        "--iterate-rules",
+        action='store_true',
+        help="repeat each shape's rules until they entail nothing new",
+    )
+
+    parser.add_argument(
+        "--trace",
+        help="write a Chrome trace-event JSON file of the time spent in each stage",
+    )
+
+    parser.add_argument(
+        "--upload-concurrency",
+        type=int,
+        default=UPLOAD_CONCURRENCY,
+        help="maximum number of concurrent uploads to the triplestore - default = {}".format(UPLOAD_CONCURRENCY),
+    )
+
+    parser.add_argument(
+        "--profile-rules",
+        action='store_true',
+        help="report the time taken, focus nodes and triples added by each SHACL rule ( not with --engine pyshacl )",
+    )
+
+    parser.add_argument(
+        "--slow-rule",
+        type=float,
+        default=1.0,
+        help="with --profile-rules, list each application of a rule taking longer than this many seconds - default = 1",
+    )
+
     args = parser.parse_args()
+    try:
+        shard = parse_shard(args.shard) if args.shard else None
+    except ValueError as e:
+        parser.error(str(e))
 
     if args.server:
         RDF4JSERVER = args.server
     if args.triplerepo:
         REPO = args.triplerepo
+    UPLOAD_CONCURRENCY = args.upload_concurrency
+    DELTA_UPLOAD = args.delta
+    PARSE_CACHE = not args.no_parse_cache
+    ENGINE = args.engine
+    ITERATE_RULES = args.iterate_rules
+    if args.trace or args.profile_rules:
+        STAGE_TIMINGS = []
+
+    write_jsonld_context()
 
     modlist = []
     addedlist = []
@@ -402,23 +1916,35 @@ if __name__ == "__main__":
         modlist = args.modified.split(",")
     if args.added:
         addedlist = args.added.split(",")
-
+    if args.dependents:
+        changed = modlist + addedlist + (args.removed.split(",") if args.removed else [])
+        sources = set(os.path.normpath(f) for f in modlist + addedlist)
+        dependents = [f for f in get_dependents(changed) if f not in sources]
+        print("Dependents: " + ",".join(dependents))
+        modlist += dependents
+
+    work = []
+    manifests = {}
+    # { scopepath: { file: seconds } } - see load_build_seconds()
+    build_seconds = {}
     for scopepath in DOMAIN_CFG.keys():
         cfglist = DOMAIN_CFG[scopepath]
         if not isinstance( cfglist,list) :
             cfglist = [cfglist]
         for cfg in cfglist:
-            try:
-                annotations = cfg['annotations']
-            except:
-                annotations = []
-
             if args.domain and args.domain != scopepath:
                 continue
             modified = []
             domainlist = [os.path.normpath(i) for i in glob(scopepath+cfg['glob'])]
 
-            if args.batch:
+            if scopepath not in manifests:
+                manifests[scopepath] = load_manifest(scopepath)
+                build_seconds[scopepath] = load_build_seconds(scopepath)
+
+            if args.incremental and not args.force:
+                # rebuild everything whose source, rules, validator or closure changed since the last build
+                modified = [f for f in domainlist if not is_up_to_date(f, cfg, manifests[scopepath])]
+            elif args.batch:
                 # update modified list to be everything missing, or everything if -f
                 if args.force :
                     modified = domainlist
@@ -437,42 +1963,6 @@ if __name__ == "__main__":
                 if f.startswith(scopepath) and f.endswith(".ttl") and os.path.normpath(f) in domainlist:
                     p = Path(f)
                     added.append(p)
-            if modified + added :
-                if 'extraont' in cfg and cfg['extraont'] :
-                    extra_ont = get_closure_graph(cfg['extraont'])
-                else:
-                    extra_ont = None
-
-
-            for f in modified + added:
-                try:
-                    newg = perform_entailments(cfg['rulelist'],f,extra=extra_ont, anno=annotations)
-                    v = validate(data_graph=newg, ont_graph=extra_ont , inference='rdfs', shacl_graph=cfg['validator'])
-                    if True or not v[0]:
-                        with open( str(f).replace('.ttl','.txt') , "w" ) as vr:
-                            vr.write(v[2])
-                    loadable_path = make_rdf(f, g=newg, rootpath=cfg['uri_root_filter'])
-                    if args.update:
-                        loadlist = [loadable_path]
-                        if annotations:
-                            loadlist += annotations
-                        try:
-                            gname = list(get_graph_uri_for_vocab(None, newg))[0]
-                        except:
-                            gname = "x-urn:{}".format(str(f).replace('\\', ':'))
-                        for n,loadable in enumerate(loadlist):
-                            try:
-                                # need to add annotations to a new context
-                                loc = load_vocab( loadable, gname)
-                                log("Uploaded {} for {} to   {} ".format(loadable, f, loc))
-                            except  Exception as e:
-                                log("Failed to upload {} for {} : ( {} )".format(loadable, f, e))
-                            if n == 0 :
-                                gname = gname+str(n+1)
-                            else:
-                                gname = gname[:-1] +str(n+1)
-                except Exception as e:
-                    log("Failed to generate {} : ( {}  )".format(f, e))
 
             removed = []
             if args.removed:
@@ -482,28 +1972,138 @@ if __name__ == "__main__":
                         p = Path(f)
                         removed.append(p)
 
-        #i = Path(__file__).parent.parent / "vocabularies" / "index.json"
-        #with open(i, "r") as f:
-        #    mappings = json.load(f)
-        # remove all removed and modified vocabs
-        #remove_vocabs(removed + modified, mappings)
-
-        # add all added and modified vocabs
-        #add_vocabs(added + modified, mappings)
-
-            # print for testing
-            print ( "Scope : {}".format(scopepath))
-            if modified:
-                print("modified:")
-                print([str(x) for x in modified])
-            if added:
-                print("added:")
-                print([str(x) for x in added])
-            if removed:
-                print("removed:")
-                print([str(x) for x in removed])
+            work.append((scopepath, cfg, modified, added, removed))
+
+    if shard:
+        work = select_shard(work, *shard, build_seconds)
+
+    tasks = []
+    summaries = []
+    for scopepath, cfg, modified, added, removed in work:
+        ntasks = len(tasks)
+        if modified + added :
+            try:
+                with stage('domain', domain=scopepath, files=len(modified + added)):
+                    if 'extraont' in cfg and cfg['extraont'] :
+                        extra_ont = get_entailed_closure(cfg['extraont'], cfg['rulelist'])
+                    else:
+                        extra_ont = None
+                    get_entailer(cfg['rulelist'])
+                    get_validator(cfg['validator'])
+                for f in modified + added:
+                    tasks.append((scopepath, cfg, f, extra_ont))
+            except Exception as e:
+                log("Failed to generate {} : ( {}  )".format(scopepath, e))
+        summaries.append((scopepath, cfg, modified, added, removed, len(tasks) - ntasks))
+
+    # the pre-loaded closure graphs in _TASKS are inherited by forked workers rather than re-parsed
+    _TASKS = tasks
+    costs = get_costs([(scopepath, f) for scopepath, _, f, _ in tasks], build_seconds)
+    # the most expensive files first, so none is left running alone at the end
+    results = run_tasks(len(tasks), args.jobs, order=sorted(range(len(tasks)), key=lambda i: -costs[i]))
+    # uploads are reported in order at the end. A process forked while upload threads run may deadlock on a lock one
+    # of them held - so uploads start as soon as each file is entailed only with worker processes, which are all
+    # forked before the first upload. Files entailed in this process may fork to serialise large graphs, so
+    # their uploads wait until all files are done
+    uploader = ThreadPoolExecutor(max_workers=args.upload_concurrency)
+    uploads = []
+    deferred = get_jobs(len(tasks), args.jobs) == 1
+    uploaded = []
+    annotated = set()
+    # graphs to drop : those of removed files, and those modified files are no longer uploaded to
+    dropped = {}
+    # numbered annotation graphs of the dropped graphs, left by earlier versions - see get_legacy_annotation_graphs()
+    legacy = {}
+    uploadgraphs = set()
+
+    for scopepath, cfg, modified, added, removed, ntasks in summaries:
+        # a domain whose closure failed to entail has no tasks
+        for f in (modified + added if ntasks else []):
+            output, result, seconds = next(results)
+            print(output, end='')
+            if result:
+                previous = manifests[scopepath].get(Path(f).as_posix(), {})
+                entry = get_manifest_entry(f, cfg, *result)
+                build_seconds[scopepath][Path(f).as_posix()] = round(seconds, 1)
+                manifests[scopepath][Path(f).as_posix()] = entry
+                stale = [g for g in previous.get('graphs', []) if g not in entry['graphs']]
+                if stale:
+                    dropped[(scopepath, Path(f).as_posix())] = stale
+                    legacy[(scopepath, Path(f).as_posix())] = [
+                        a for g in stale for a in get_legacy_annotation_graphs(g, cfg.get('annotations', []))]
+                uploadgraphs.update(entry['graphs'])
+            if result and args.update and not args.initialise:
+                uploads += [(_upload, u) for u in get_uploads(f, *result)]
+                # each annotation file once per run, however many files and domains it annotates
+                for annotation in cfg.get('annotations', []):
+                    if annotation not in annotated:
+                        annotated.add(annotation)
+                        uploads.append((upload_annotation, annotation))
+            if not deferred:
+                uploaded += [uploader.submit(*u) for u in uploads]
+                uploads = []
+        for f in removed:
+            if Path(f).as_posix() in manifests[scopepath]:
+                dropped[(scopepath, Path(f).as_posix())] = manifests[scopepath][Path(f).as_posix()].get('graphs', [])
+                # removed files are listed for every configuration of a domain - only the one matching the file
+                # tells how many annotation graphs it had
+                if Path(f).match(scopepath + cfg['glob']):
+                    legacy[(scopepath, Path(f).as_posix())] = [
+                        a for g in dropped[(scopepath, Path(f).as_posix())]
+                        for a in get_legacy_annotation_graphs(g, cfg.get('annotations', []))]
+            else:
+                log("Warning - no graphs recorded in {} for removed file {}".format(get_manifest_path(scopepath), f))
+
+        if ntasks:
+            save_manifest(scopepath, manifests[scopepath])
+            if args.batch and not shard:
+                save_build_seconds(scopepath, build_seconds[scopepath])
+
+        # print for testing
+        print ( "Scope : {}".format(scopepath))
+        if modified:
+            print("modified:")
+            print([str(x) for x in modified])
+        if added:
+            print("added:")
+            print([str(x) for x in added])
+        if removed:
+            print("removed:")
+            print([str(x) for x in removed])
+
+    if tasks:
+        log("{} outputs and validation reports written, {} unchanged".format(OUTPUTS['written'], OUTPUTS['unchanged']))
+    uploaded += [uploader.submit(*u) for u in uploads]
+    for u in uploaded:
+        log(u.result())
+    uploader.shutdown()
+    if dropped and args.update and not args.initialise:
+        try:
+            recorded = get_recorded_graphs()
+            mappings = {f: g + [a for a in legacy.get((scopepath, f), []) if a not in recorded]
+                        for (scopepath, f), g in dropped.items()}
+            graphs = remove_vocabs([f for _, f in dropped], mappings, keep=uploadgraphs)
+            log("Removed graphs {} from {}".format(", ".join(graphs), REPO))
+            for scopepath, f in dropped:
+                if not os.path.exists(f):
+                    manifests[scopepath].pop(f, None)
+            for scopepath in set(scopepath for scopepath, _ in dropped):
+                save_manifest(scopepath, manifests[scopepath])
+        except Exception as e:
+            log("Failed to remove graphs from {} : ( {} )".format(REPO, e))
+    if args.initialise:
+        try:
+            log("Initialised {} with {} graphs ( {} quads )".format(REPO, *initialise(args.domain, args.gzip)))
+        except Exception as e:
+            log("Failed to initialise {} : ( {} )".format(REPO, e))
+    if args.trace:
+        write_trace(args.trace, STAGE_TIMINGS)
+        print("Trace of {} stages written to {}".format(len(STAGE_TIMINGS), args.trace))
+    if args.profile_rules:
+        print_rule_profile(STAGE_TIMINGS, args.slow_rule)
+    if args.watch:
+        watch(args.domain, args.update)
 
     # rebuild VocPrez' cache
     #r = httpx.get("http://defs-dev.opengis.net/vocprez/cache-reload")
     #assert r.status_code == 200
-